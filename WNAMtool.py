@@ -1,9 +1,27 @@
 import math
+import mmap
+import array
 import struct
 import os
+import pickle
+import hashlib
+import zlib
+import ast
+import itertools
+import operator
+import concurrent.futures
+import contextlib
+import time
+import json
 import sys
 import getopt
 
+# Only used to report peak memory, which isn't available on every platform
+try:
+    import resource
+except ImportError:
+    resource = None
+
 # Automatically convert i/o strings/bytes to bytes/strings
 # Allow variable string length
 def pack(*args):
@@ -40,6 +58,37 @@ def unpack(*args):
 def padLength(length, pad):
     return int(pad * math.ceil(length/pad))
 
+# Regions are (left, bottom, right, top) tuples of inclusive cell coordinates
+# A region of None contains every cell
+def inRegion(coords, region):
+    if region is None:
+        return True
+    return region[0] <= coords[0] <= region[2] and region[1] <= coords[1] <= region[3]
+
+# Returns the cells contained in both regions, which may be none
+def regionIntersection(region, otherRegion):
+    if region is None:
+        return otherRegion
+    if otherRegion is None:
+        return region
+    return (max(region[0], otherRegion[0]), max(region[1], otherRegion[1]),
+        min(region[2], otherRegion[2]), min(region[3], otherRegion[3]))
+
+# Returns the smallest region containing every cell in coordsList, which can't be empty
+def boundingRegion(coordsList):
+    return (min(x for x, y in coordsList), min(y for x, y in coordsList),
+        max(x for x, y in coordsList), max(y for x, y in coordsList))
+
+# Groups cells by row, returning {y: [x, ...]} with each row sorted from left to right
+# Maps can then be built one row at a time without scanning every coordinate
+def cellRows(coordsList):
+    rows = {}
+    for x, y in sorted(coordsList, key=lambda coords: (coords[1], coords[0])):
+        if not y in rows:
+            rows[y] = []
+        rows[y].append(x)
+    return rows
+
 class ColorTable():
 
     def getSize(self):
@@ -69,6 +118,15 @@ class ColorTable():
     def rgba(self, index):
         return self.value[index]
 
+    # Table for bytes.translate mapping pixel indices to WNAM bytes
+    # Heights are taken from red values, which are unsigned, so they're shifted by 128
+    # Indices without a color map to 0
+    def heightTable(self):
+        table = bytearray(256)
+        for index in range(min(len(self.value), 256)):
+            table[index] = (self.r(index) + 128) % 256
+        return bytes(table)
+
     def __init__(self, i):
         if isinstance(i, (bytes, bytearray)):
             self.size = len(i)
@@ -78,62 +136,6 @@ class ColorTable():
             if not hasattr(self, 'size'):
                 self.getSize()
 
-# Keep this as bytes so we don't use a lot of memory
-class PixelArray():
-
-    def getSize(self):
-        self.size = self.height * self.padWidth
-
-    def to_bytes(self, v):
-        b = bytearray()
-        for row in v:
-            b += bytearray(row) + bytearray(self.padWidth - self.width)
-        return b
-
-    def from_bytes(self):
-        v = []
-        for i in range(self.height):
-            i *= self.padWidth
-            v.append(list(self.value[i:i + self.width]))
-        return v
-
-    def getRow(self, x, y, length):
-        if not length:
-            x = 0
-            length = self.width
-        baseRow = y * self.padWidth
-        baseColumn = baseRow + x
-        return self.value[baseColumn:baseColumn+length]
-
-    def setRow(self, x, y, b):
-        b = b[:self.width - x]
-        baseRow = y * self.padWidth
-        baseColumn = baseRow + x
-        self.value[baseColumn:baseColumn+len(b)] = b
-
-    def impose(self, pixelArray, x, y):
-        for h in range(pixelArray.height):
-            b = pixelArray.getRow(0, h, 0)
-            self.setRow(x, y + h, b)
-
-    def crop(self, x, y, width, height):
-        cropped = []
-        for h in range(height):
-            cropped.append(self.getRow(x, y + h, width))
-        return PixelArray(cropped, width, height, width)
-
-    def __init__(self, i, width, height, padWidth):
-        self.width = int(width)
-        self.height = int(height)
-        self.padWidth = int(padWidth)
-        if not isinstance(i, (bytes, bytearray)):
-            if not hasattr(self, 'size'):
-                self.getSize()
-            self.value = self.to_bytes(i)
-        else:
-            self.size = len(i)
-            self.value = i
-
 # Record dict structure:
 #{
 #    'tag': 4 character string,
@@ -152,13 +154,20 @@ class PixelArray():
 #}
 
 class Subrecord():
+
+    __slots__ = ('tag', 'data')
     
     def pack(self):
         info = pack('<4sI', self.tag, len(self.data))
         return info + self.data
 
+    # Copy data out of a memory-mapped plugin so it can be used like other subrecords
+    def decode(self):
+        if isinstance(self.data, memoryview):
+            self.data = bytearray(self.data)
+
     def __repr__(self):
-        return '{}: {:X}\n'.format(self.tag, self.data)
+        return '{}: {}\n'.format(self.tag, bytes(self.data).hex().upper())
 
     def __init__(self, i):
         if not i:
@@ -167,29 +176,41 @@ class Subrecord():
             self.tag = i['tag']
             self.data = i['data']
         else:
-            self.tag, size = unpack('<4sI', i.read(8))
-            self.data = bytearray(i.read(size))
+            tag, size = unpack('<4sI', i.read(8))
+            # Tags repeat constantly, so share one string for each
+            self.tag = sys.intern(tag)
+            # Data read from a PluginView stays a slice of the mapped file until it's needed
+            data = i.read(size)
+            if isinstance(data, memoryview):
+                self.data = data
+            else:
+                self.data = bytearray(data)
 
+# Subrecords are stored in a dict under increasing integer keys, which keeps them in order
+# subrecordsSorted maps each tag to a tuple of its subrecords' keys, so they can be found, replaced and deleted directly
 class Record():
 
+    __slots__ = ('tag', 'flags', 'subrecords', 'subrecordsSorted', 'nextKey', 'pluginName', 'offset', 'id', 'passed')
+
     def pack(self):
         data = bytearray()
-        for subrecord in self.subrecords:
+        for subrecord in self.subrecords.values():
             data += subrecord.pack()
         info = pack('<4sI4xI', self.tag, len(data), self.flags)
         return info + data
 
     def sortSubrecords(self):
-        for subrecord in self.subrecords:
-            if not subrecord.tag in self.subrecordsSorted:
-                self.subrecordsSorted[subrecord.tag] = []
-            self.subrecordsSorted[subrecord.tag].append(subrecord)
+        self.subrecordsSorted = {}
+        for key, subrecord in self.subrecords.items():
+            self.subrecordsSorted[subrecord.tag] = self.subrecordsSorted.get(subrecord.tag, ()) + (key,)
 
     def getSubrecord(self, tag, index=0):
         try:
-            return self.subrecordsSorted[tag][index]
+            subrecord = self.subrecords[self.subrecordsSorted[tag][index]]
         except:
             return None
+        subrecord.decode()
+        return subrecord
 
     def addSubrecord(self, subrecord):
         if not subrecord:
@@ -198,10 +219,10 @@ class Record():
         if isinstance(subrecord, dict):
             subrecord = Subrecord(subrecord)
         
-        self.subrecords.append(subrecord)
-        if not subrecord.tag in self.subrecordsSorted:
-            self.subrecordsSorted[subrecord.tag] = []
-        self.subrecordsSorted[subrecord.tag].append(subrecord)
+        key = self.nextKey
+        self.nextKey += 1
+        self.subrecords[key] = subrecord
+        self.subrecordsSorted[subrecord.tag] = self.subrecordsSorted.get(subrecord.tag, ()) + (key,)
         
 
     def setSubrecord(self, rep, index=0):
@@ -215,105 +236,226 @@ class Record():
             self.addSubrecord(rep)
             return
         
-        count = 0
-        for i in range(len(self.subrecords)):
-            subrecord = self.subrecords[i]
-            if subrecord.tag == rep.tag:
-                if count == index:
-                    self.subrecords[i] = rep
-                    self.subrecordsSorted[rep.tag][count] = rep
-                    return True
-                count += 1
-        return False
+        self.subrecords[self.subrecordsSorted[rep.tag][index]] = rep
+        return True
 
     def delSubrecord(self, tag, index=0):
-        count = 0
-        for i in range(len(self.subrecords)):
-            subrecord = self.subrecords[i]
-            if subrecord.tag == tag:
-                if count == index:
-                    del self.subrecords[i]
-                    del self.subrecordsSorted[tag][count]
-                    if len(self.subrecordsSorted[tag]) <= 0:
-                        del self.subrecordsSorted[tag]
-                    return True
-                count += 1
-        return False
+        keys = self.subrecordsSorted.get(tag)
+        if not keys or index >= len(keys):
+            return False
+        del self.subrecords[keys[index]]
+        keys = keys[:index] + keys[index+1:]
+        if len(keys) <= 0:
+            del self.subrecordsSorted[tag]
+        else:
+            self.subrecordsSorted[tag] = keys
+        return True
 
     # Used to replace records, or identify them easily
+    # LANDs are identified by (x, y) and LTEX by (plugin name, index)
     def setId(self):
         if self.tag == 'TES3':
-            if hasattr(self, 'plugin'):
-                self.id = self.plugin['name'].lower()
+            self.id = self.pluginName.lower()
         elif self.tag == 'LAND':
-            x, y = unpack('<2i', (self.getSubrecord('INTV').data))
-            self.id = '{:d},{:d}'.format(x, y)
+            self.id = unpack('<2i', (self.getSubrecord('INTV').data))
         elif self.tag == 'LTEX':
             index, = unpack('<I', self.getSubrecord('INTV').data)
-            self.id = '{} {}'.format(self.plugin['name'], str(index))
+            self.id = (self.pluginName, index)
 
-    def setName(self):
-        if hasattr(self, 'id'):
-            self.name = self.id
-        else:
-            self.name = '{} {:X}'.format(self.plugin['name'], self.plugin['offset'])
+    @property
+    def name(self):
+        if self.id is not None:
+            return self.id
+        return '{} {:X}'.format(self.pluginName, self.offset)
 
     def __repr__(self):
         text = '{}:\nflags: {:b}\nsubrecords:\n'.format(self.tag, self.flags)
-        for subrecord in self.subrecords:
+        for subrecord in self.subrecords.values():
             text += repr(subrecord)
 
         return text
 
-    def __init__(self, i, tags=False):
+    # resolved may contain ids of LANDs that are already known, which are skipped after reading their coordinates
+    # LANDs outside of region are skipped the same way
+    # pluginName defaults to the filename of the plugin being read
+    def __init__(self, i, tags=False, resolved=None, region=None, pluginName=None):
         if not i:
             return
 
         self.passed = False
-        self.subrecords = []
+        self.subrecords = {}
         self.subrecordsSorted = {}
+        self.nextKey = 0
+        self.id = None
         
         if isinstance(i, dict):
             self.tag = i['tag']
             self.flags = i['flags']
-            self.plugin = {'name':'New', 'offset':False}
+            self.pluginName = 'New'
+            self.offset = False
             for subrecord in i['subrecords']:
                 self.addSubrecord(subrecord)
         else:
             start = i.tell()
             info = i.read(0x10)
-            self.plugin = {'name':os.path.basename(i.name), 'offset':start}
+            self.pluginName = pluginName or os.path.basename(i.name)
+            self.offset = start
             if not info:
                 self.passed = True
                 return
-            self.tag, size, self.flags = unpack('<4sI4xI', info)
+            tag, size, self.flags = unpack('<4sI4xI', info)
+            self.tag = sys.intern(tag)
             if tags and not self.tag in tags:
                 i.seek(size, 1)
                 self.passed = True
                 return
-            
+
             offset = i.tell()
+            if (resolved or region) and self.tag == 'LAND':
+                while offset < start + size + 0x10:
+                    subTag, subSize = unpack('<4sI', i.read(8))
+                    if subTag == 'INTV':
+                        coords = unpack('<2i', i.read(subSize))
+                        if (resolved and coords in resolved) or not inRegion(coords, region):
+                            i.seek(start + size + 0x10)
+                            self.passed = True
+                            return
+                        break
+                    i.seek(subSize, 1)
+                    offset = i.tell()
+                i.seek(start + 0x10)
+                offset = i.tell()
+            
             while offset < start + size + 0x10:
                 subrecord = Subrecord(i)
                 self.addSubrecord(subrecord)
                 offset = i.tell()
             
         self.setId()
-        self.setName()
 
 
-######## BMP/image handling ########
+# Read-only, file-like view of a memory-mapped plugin
+# Reads return memoryview slices of the file instead of copies
+class PluginView():
+
+    def read(self, size=-1):
+        start = self.offset
+        end = len(self.view)
+        if size >= 0:
+            end = min(start + size, end)
+        self.offset = end
+        return self.view[start:end]
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += len(self.view)
+        self.offset = offset
+        return offset
+
+    # Subrecords may still reference the mapping, so it's left open until they're gone
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __init__(self, path):
+        self.name = path
+        self.offset = 0
+        with open(path, mode='rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
 
 
-heightPaletteMono = []
-for i in range(128, 256):
-    heightPaletteMono.append([i, i, i, 0])
-for i in range(128):
-    heightPaletteMono.append([i, i, i, 0])
-heightPaletteMono = ColorTable(heightPaletteMono)
+######## Instrumentation ########
+
+
+# Times phases and tallies counters for --profile and --stats-json
+# When disabled, phases and counters do nothing, so code using them doesn't need to check first
+# Progress messages are printed unless quiet is set
+class Stats():
+
+    def phase(self, name):
+        if not self.enabled:
+            return self.nullPhase
+        return StatsPhase(self, name)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def progress(self, message, end='\n'):
+        if not self.quiet:
+            print(message, end=end, flush=True)
+
+    # Peak resident memory of this process in bytes, or None if it can't be found
+    def peakMemory(self):
+        if not resource:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS reports bytes
+        if sys.platform != 'darwin':
+            peak *= 1024
+        return peak
+
+    def report(self):
+        return {
+            'seconds':time.perf_counter() - self.start,
+            'phases':dict(self.phases),
+            'counters':dict(self.counters),
+            'peakMemory':self.peakMemory()
+        }
+
+    def summary(self):
+        report = self.report()
+        lines = ['Profile:']
+        for name, seconds in report['phases'].items():
+            lines.append('    {:<24}{:>10.3f}s'.format(name, seconds))
+        lines.append('    {:<24}{:>10.3f}s'.format('total', report['seconds']))
+        for name, value in report['counters'].items():
+            lines.append('    {:<24}{:>11d}'.format(name, value))
+        if report['peakMemory'] is not None:
+            lines.append('    {:<24}{:>8.1f} MB'.format('peak memory', report['peakMemory'] / 1e6))
+        return '\n'.join(lines)
+
+    def __init__(self, enabled=True, quiet=False):
+        self.enabled = enabled
+        self.quiet = quiet
+        self.phases = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+        self.nullPhase = contextlib.nullcontext()
+
+# Adds the time spent inside a with block to a phase; phases with the same name add up
+class StatsPhase():
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        phases = self.stats.phases
+        phases[self.name] = phases.get(self.name, 0) + time.perf_counter() - self.start
+        return False
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+# Used when functions aren't given stats, so they run silently without collecting anything
+quietStats = Stats(False, True)
+
+
+######## BMP/image handling ########
 
-# Color palette for Morrowind's in-game map
-heightPaletteColor = ColorTable(bytearray([
+
+# Colors of Morrowind's in-game map
+heightColors = bytes([
     0x21, 0x30, 0x42, 0xFF, 0x20, 0x2E, 0x40, 0xFF, 0x1F, 0x2D, 0x3E, 0xFF, 0x1E, 0x2B, 0x3C, 0xFF, 0x1D, 0x2A, 0x3A, 0xFF, 0x1C, 0x28, 0x38, 0xFF, 0x1B, 0x27, 0x36, 0xFF, 0x1A, 0x25, 0x34, 0xFF,
     0x19, 0x24, 0x32, 0xFF, 0x18, 0x23, 0x30, 0xFF, 0x17, 0x21, 0x2E, 0xFF, 0x16, 0x20, 0x2C, 0xFF, 0x15, 0x1E, 0x2A, 0xFF, 0x14, 0x1D, 0x28, 0xFF, 0x14, 0x1D, 0x28, 0xFF, 0x13, 0x1D, 0x27, 0xFF,
     0x13, 0x1D, 0x27, 0xFF, 0x13, 0x1C, 0x27, 0xFF, 0x13, 0x1C, 0x27, 0xFF, 0x13, 0x1C, 0x26, 0xFF, 0x13, 0x1C, 0x26, 0xFF, 0x13, 0x1C, 0x26, 0xFF, 0x13, 0x1B, 0x26, 0xFF, 0x12, 0x1B, 0x25, 0xFF,
@@ -346,7 +488,24 @@ heightPaletteColor = ColorTable(bytearray([
     0x2F, 0x34, 0x23, 0xFF, 0x2F, 0x34, 0x23, 0xFF, 0x2F, 0x34, 0x23, 0xFF, 0x30, 0x34, 0x23, 0xFF, 0x30, 0x34, 0x23, 0xFF, 0x30, 0x35, 0x23, 0xFF, 0x30, 0x35, 0x24, 0xFF, 0x30, 0x35, 0x24, 0xFF,
     0x30, 0x35, 0x24, 0xFF, 0x30, 0x35, 0x24, 0xFF, 0x31, 0x35, 0x24, 0xFF, 0x31, 0x35, 0x24, 0xFF, 0x31, 0x36, 0x24, 0xFF, 0x31, 0x36, 0x24, 0xFF, 0x31, 0x36, 0x24, 0xFF, 0x31, 0x36, 0x25, 0xFF,
     0x31, 0x36, 0x25, 0xFF, 0x32, 0x36, 0x25, 0xFF, 0x32, 0x37, 0x25, 0xFF, 0x32, 0x37, 0x25, 0xFF, 0x32, 0x37, 0x25, 0xFF, 0x32, 0x37, 0x25, 0xFF, 0x32, 0x37, 0x25, 0xFF, 0x32, 0x37, 0x25, 0xFF
-]))
+])
+
+# Palettes are only built the first time they're used, so importing this module stays cheap
+heightPalettes = {}
+
+# Returns the grayscale palette, or the in-game map palette if colored is set
+def heightPalette(colored=False):
+    if not colored in heightPalettes:
+        if colored:
+            heightPalettes[colored] = ColorTable(bytearray(heightColors))
+        else:
+            mono = []
+            for i in range(128, 256):
+                mono.append([i, i, i, 0])
+            for i in range(128):
+                mono.append([i, i, i, 0])
+            heightPalettes[colored] = ColorTable(mono)
+    return heightPalettes[colored]
 
 baseBMPheader = {
     'Signature':        {'format': '<2s', 'value': 'BM', 'error': 'Not a valid .BMP file.'},
@@ -374,222 +533,1325 @@ def parseBMPHeader(f):
         default = item['value']
         size = struct.calcsize(itemFormat)
         itemBytes = f.read(size)
+        if len(itemBytes) < size:
+            return baseBMPheader['Signature']['error']
         data, = unpack(itemFormat, itemBytes)
 
         if data != default and 'error' in item:
-            print(header[item]['error'])
-            return False
+            return item['error']
 
         header[itemName] = {'format':itemFormat, 'value':data}
         offset += size
     return header
 
-def WNAMsFromBMP(bmpPath, coords):
-    pixelArray = None
-    with open(bmpPath, mode='rb') as img:
-        header = parseBMPHeader(img)
-        if not header:
-            return False
-        
-        palette = ColorTable(img.read(header['ColorsUsed']['value'] * 4))
-        size = header['ImageSize']['value']
-        width = header['Width']['value']
-        height = header['Height']['value']
-        
-        if width % 9 > 0 or height % 9 > 0:
-            print('Image dimensions must be divisible by 9.')
-            return False
-        
-        padWidth = size / height
-        if size == 0:
-            # We'll assume that image editors pad rows to multiples of 4 bytes
-            padWidth = padLength(width, 4)
-            size = padWidth * height
-
-        pixelData = img.read(size)
-        b = bytearray()
-        # Image editors cannot be relied upon to preserve color tables
-        for pixel in pixelData:
-            red = palette.r(pixel)
-            if red >= 128:
-                red -= 128
+# Splits 9 padded pixel rows into the WNAMs of each cell, the inverse of bandFromWNAMs
+def WNAMsFromBand(band, cellWidth, padWidth):
+    width = cellWidth * 9
+    cells = bytearray(cellWidth * 81)
+    for row in range(9):
+        base = row * padWidth
+        for column in range(9):
+            cells[row * 9 + column::81] = band[base + column:base + width:9]
+    return [cells[i:i + 81] for i in range(0, len(cells), 81)]
+
+# Box filter bounds for reducing scale pixels to the 9 of a WNAM, as (start, end) for each of the 9
+def boxBounds(scale):
+    return [(i * scale // 9, (i + 1) * scale // 9) for i in range(9)]
+
+# Reduces scale rows of pixels, bottom row first, to the WNAMs of the cells they cover by averaging each box of pixels
+# Pixels range from 0 to maxValue, which is spread over the range of a WNAM the same way as grayscale BMPs
+def WNAMsFromPixelRows(rows, cellWidth, scale, maxValue):
+    bounds = boxBounds(scale)
+    starts = [x * scale + start for x in range(cellWidth) for start, end in bounds]
+    ends = [x * scale + end for x in range(cellWidth) for start, end in bounds]
+    widths = list(map(operator.sub, ends, starts))
+    cells = bytearray(cellWidth * 81)
+    for row, (start, end) in enumerate(bounds):
+        # Each box's rows are summed first, then running sums along the result give each box's total
+        columnSums = list(map(sum, zip(*rows[start:end])))
+        totals = list(itertools.accumulate(columnSums, initial=0))
+        boxSums = map(operator.sub, map(totals.__getitem__, ends), map(totals.__getitem__, starts))
+        divisor = (end - start) * (maxValue + 1)
+        # Shifting by 128 makes the averages signed bytes
+        values = bytes([(boxSum * 256 // (width * divisor)) ^ 128 for boxSum, width in zip(boxSums, widths)])
+        for column in range(9):
+            cells[row * 9 + column::81] = values[column::9]
+    return [cells[i:i + 81] for i in range(0, len(cells), 81)]
+
+# Turns a table mapping pixels to the unsigned bytes of WNAMs into one mapping them to heights in order, which averaging needs
+def orderedHeightTable(table):
+    return bytes(value ^ 128 for value in table)
+
+# Reads the header and palette of a BMP, leaving f at its palette's end
+# Returns {'width', 'height', 'offset', 'padWidth', 'table'}, or a message saying why if it can't be used
+def BMPInfo(f):
+    header = parseBMPHeader(f)
+    if isinstance(header, str):
+        return header
+
+    # A color count of 0 means the palette has every color
+    colors = header['ColorsUsed']['value'] or 256
+    palette = ColorTable(f.read(colors * 4))
+    size = header['ImageSize']['value']
+    width = header['Width']['value']
+    height = header['Height']['value']
+
+    padWidth = size // height
+    if size == 0:
+        # We'll assume that image editors pad rows to multiples of 4 bytes
+        padWidth = padLength(width, 4)
+
+    # Image editors cannot be relied upon to preserve color tables
+    return {'width':width, 'height':height, 'offset':header['DataOffset']['value'], 'padWidth':padWidth, 'table':palette.heightTable()}
+
+# Reads scale rows of pixels at a time, yielding ((x, y), WNAM bytes) for each cell
+# Rows of cells outside of region aren't read at all
+def streamWNAMsFromBMP(img, coords, header, cellWidth, cellHeight, scale=9, region=None):
+    try:
+        padWidth = header['padWidth']
+        table = header['table']
+        bandSize = padWidth * scale
+        width = cellWidth * scale
+        if scale != 9:
+            table = orderedHeightTable(table)
+        for y in range(cellHeight):
+            if region is not None and not region[1] <= coords[1] + y <= region[3]:
+                continue
+            img.seek(header['offset'] + y * bandSize)
+            band = img.read(bandSize).translate(table)
+            if scale == 9:
+                WNAMs = WNAMsFromBand(band, cellWidth, padWidth)
             else:
-                red += 128
-            b.append(red)
-        pixelArray = PixelArray(b, width, height, padWidth)
-    
-    WNAMs = {}
-
-    cellWidth = int(width / 9)
-    cellHeight = int(height / 9)
+                rows = [band[row * padWidth:row * padWidth + width] for row in range(scale)]
+                WNAMs = WNAMsFromPixelRows(rows, cellWidth, scale, 255)
+            for x, WNAM in enumerate(WNAMs):
+                if inRegion((coords[0] + x, coords[1] + y), region):
+                    yield (coords[0] + x, coords[1] + y), WNAM
+    finally:
+        img.close()
+
+# Reads the header of a binary PGM, leaving f at the start of its pixels
+# Returns {'width', 'height', 'offset', 'maxValue'}, or a message saying why if it can't be used
+def parsePGMHeader(f):
+    fields = []
+    token = b''
+    while len(fields) < 4:
+        char = f.read(1)
+        if char == b'#':
+            f.readline()
+            continue
+        if not char or char.isspace():
+            if token:
+                fields.append(token)
+                token = b''
+            if not char:
+                break
+            continue
+        token += char
 
-    for x in range(cellWidth):
-        for y in range(cellHeight):
-            key = '{:d},{:d}'.format(coords[0]+x, coords[1]+y)
-            data = pixelArray.crop(x*9,y*9,9,9).value
-            subrecord = Subrecord({'tag':'WNAM', 'data':data})
-            WNAMs[key] = subrecord
+    if len(fields) < 4 or fields[0] != b'P5':
+        return 'Only binary grayscale PGMs are supported.'
+    try:
+        width, height, maxValue = [int(field) for field in fields[1:]]
+    except ValueError:
+        return 'Not a valid .PGM file.'
+    if not 0 < maxValue < 65536:
+        return 'Not a valid .PGM file.'
+    return {'width':width, 'height':height, 'offset':f.tell(), 'maxValue':maxValue}
+
+# Like streamWNAMsFromBMP, for 8 or 16-bit grayscale PGMs
+# PGMs are stored top row first, and have 2 big-endian bytes per pixel if their maximum value doesn't fit in 1
+# Gray values are spread over the range of a WNAM, with black being the lowest
+def streamWNAMsFromPGM(img, coords, header, cellWidth, cellHeight, scale=9, region=None):
+    try:
+        maxValue = header['maxValue']
+        typecode = 'B'
+        if maxValue > 255:
+            typecode = 'H'
+        width = cellWidth * scale
+        bandSize = width * scale * array.array(typecode).itemsize
+        for row in range(cellHeight):
+            y = coords[1] + cellHeight - 1 - row
+            if region is not None and not region[1] <= y <= region[3]:
+                continue
+            img.seek(header['offset'] + row * bandSize)
+            pixels = array.array(typecode)
+            pixels.frombytes(img.read(bandSize))
+            if typecode == 'H' and sys.byteorder == 'little':
+                pixels.byteswap()
+            rows = [pixels[i:i + width] for i in range(0, len(pixels), width)]
+            rows.reverse()
+            for x, WNAM in enumerate(WNAMsFromPixelRows(rows, cellWidth, scale, maxValue)):
+                if inRegion((coords[0] + x, y), region):
+                    yield (coords[0] + x, y), WNAM
+    finally:
+        img.close()
+
+PNGSignature = b'\x89PNG\r\n\x1a\n'
+
+# Reads the signature and IHDR chunk of a PNG, leaving f at the chunk after IHDR
+# Returns {'width', 'height', 'bitDepth', 'colorType'}, or a message saying why if it can't be used
+def parsePNGHeader(f):
+    if f.read(8) != PNGSignature:
+        return 'Not a valid .PNG file.'
+    info = f.read(8)
+    if len(info) < 8 or unpack('>I4s', info) != (13, 'IHDR'):
+        return 'Not a valid .PNG file.'
+    width, height, bitDepth, colorType, compression, filterMethod, interlace = unpack('>2I5B', f.read(13))
+    f.seek(4, 1)
+    if not (colorType == 3 and bitDepth == 8) and not (colorType == 0 and bitDepth in [8, 16]):
+        return 'Only 8-bit paletted and 8 or 16-bit grayscale PNGs are supported.'
+    if interlace != 0:
+        return 'Interlaced PNGs aren\'t supported.'
+    return {'width':width, 'height':height, 'bitDepth':bitDepth, 'colorType':colorType}
+
+# Reads a PNG up to its first IDAT chunk, leaving f there
+# Returns the header from parsePNGHeader with 'pixelSize', 'maxValue' and 'table' added, or a message saying why if it can't be used
+# table is None for grayscale PNGs
+def PNGInfo(f):
+    header = parsePNGHeader(f)
+    if isinstance(header, str):
+        return header
+
+    # The palette comes before the first IDAT chunk, which is where reading pixels starts
+    palette = None
+    while True:
+        info = f.read(8)
+        if len(info) < 8:
+            return 'Not a valid .PNG file.'
+        size, tag = unpack('>I4s', info)
+        if tag == 'IDAT':
+            f.seek(-8, 1)
+            break
+        if tag == 'PLTE':
+            colors = f.read(size)
+            # Palettes are stored as RGB, while ColorTable holds colors in the same order as BMPs
+            palette = ColorTable([[colors[i + 2], colors[i + 1], colors[i], 0] for i in range(0, size - 2, 3)])
+            f.seek(4, 1)
+        else:
+            f.seek(size + 4, 1)
+
+    header['table'] = None
+    if header['colorType'] == 3:
+        if not palette:
+            return 'Not a valid .PNG file.'
+        header['table'] = orderedHeightTable(palette.heightTable())
+    header['pixelSize'] = header['bitDepth'] // 8
+    header['maxValue'] = 2 ** header['bitDepth'] - 1
+    return header
 
-    return WNAMs
+# Adds every byte of two rows packed into ints, wrapping around at 256 like PNG filters do
+# lowBits has the low 7 bits of every byte set, which are added without carrying into the next byte
+# highBits has the top bit of every byte set, which is worked out separately
+def addPNGBytes(x, y, lowBits, highBits):
+    return ((x & lowBits) + (y & lowBits)) ^ ((x ^ y) & highBits)
+
+# Reverses the filter a PNG row was saved with, given the unfiltered row above it
+# None, Sub and Up are undone for a whole row at once, as ints holding the whole row
+# Average and Paeth depend on the unfiltered byte to the left, so they have to be undone one byte at a time,
+# which takes a few seconds for a full 4608 by 4608 map
+# Paletted PNGs are normally saved without filters anyway, which makes them as fast to read as BMPs
+def unfilterPNGRow(filterType, row, previous, pixelSize):
+    if filterType == 0:
+        return bytes(row)
+    size = len(row)
+    rowBits = (1 << size * 8) - 1
+    lowBits = int.from_bytes(b'\x7f' * size, 'little')
+    highBits = rowBits ^ lowBits
+    if filterType == 2:
+        unfiltered = addPNGBytes(int.from_bytes(row, 'little'), int.from_bytes(previous, 'little'), lowBits, highBits)
+        return unfiltered.to_bytes(size, 'little')
+    if filterType == 1:
+        # Each byte is relative to the same byte of the pixel before it, so the row is a running sum of pixels
+        # Adding the sums so far shifted over by 1, 2, 4... pixels gives every running sum in a few steps
+        unfiltered = int.from_bytes(row, 'little')
+        shift = pixelSize * 8
+        while shift < size * 8:
+            unfiltered = addPNGBytes(unfiltered, unfiltered << shift & rowBits, lowBits, highBits)
+            shift *= 2
+        return unfiltered.to_bytes(size, 'little')
+
+    # Like Sub, each byte of a pixel is handled separately, keeping its neighbours in locals instead of indexing for them
+    unfiltered = bytearray(len(row))
+    for start in range(pixelSize):
+        channel = bytearray()
+        append = channel.append
+        left = 0
+        upLeft = 0
+        if filterType == 3:
+            for value, up in zip(row[start::pixelSize], previous[start::pixelSize]):
+                left = (value + ((left + up) >> 1)) & 255
+                append(left)
+        else:
+            for value, up in zip(row[start::pixelSize], previous[start::pixelSize]):
+                # Distances from the estimate left + up - upLeft to each neighbour
+                leftDistance = up - upLeft
+                upDistance = left - upLeft
+                upLeftDistance = abs(leftDistance + upDistance)
+                leftDistance = abs(leftDistance)
+                upDistance = abs(upDistance)
+                if leftDistance <= upDistance and leftDistance <= upLeftDistance:
+                    left = (value + left) & 255
+                elif upDistance <= upLeftDistance:
+                    left = (value + up) & 255
+                else:
+                    left = (value + upLeft) & 255
+                upLeft = up
+                append(left)
+        unfiltered[start::pixelSize] = channel
+    return bytes(unfiltered)
+
+# Yields a PNG's rows of pixels, top row first, starting from its first IDAT chunk at the current position of img
+# Chunks are decompressed as they're reached, so only a few rows are ever held at once
+def PNGRows(img, width, pixelSize):
+    rowSize = width * pixelSize
+    decompressor = zlib.decompressobj()
+    pending = bytearray()
+    previous = bytes(rowSize)
+    while True:
+        info = img.read(8)
+        if len(info) < 8:
+            return
+        size, tag = unpack('>I4s', info)
+        if tag == 'IEND':
+            return
+        if tag != 'IDAT':
+            img.seek(size + 4, 1)
+            continue
+        pending += decompressor.decompress(img.read(size))
+        img.seek(4, 1)
+        while len(pending) > rowSize:
+            previous = unfilterPNGRow(pending[0], pending[1:rowSize + 1], previous, pixelSize)
+            del pending[:rowSize + 1]
+            yield previous
+
+# Like streamWNAMsFromPGM, for 8-bit paletted PNGs such as extracted ones, or 8 or 16-bit grayscale PNGs
+# Every row has to be decompressed to reach the next, even outside of region
+def streamWNAMsFromPNG(img, coords, header, cellWidth, cellHeight, scale=9, region=None):
+    try:
+        pixelSize = header['pixelSize']
+        table = header['table']
+        width = cellWidth * scale
+        rows = PNGRows(img, width, pixelSize)
+        for row in range(cellHeight):
+            y = coords[1] + cellHeight - 1 - row
+            band = list(itertools.islice(rows, scale))
+            if len(band) < scale:
+                return
+            if region is not None and not region[1] <= y <= region[3]:
+                continue
+            if pixelSize == 2:
+                band = [array.array('H', pixelRow) for pixelRow in band]
+                if sys.byteorder == 'little':
+                    for pixelRow in band:
+                        pixelRow.byteswap()
+            elif table:
+                band = [pixelRow.translate(table) for pixelRow in band]
+            band.reverse()
+            for x, WNAM in enumerate(WNAMsFromPixelRows(band, cellWidth, scale, header['maxValue'])):
+                if inRegion((coords[0] + x, y), region):
+                    yield (coords[0] + x, y), WNAM
+    finally:
+        img.close()
+
+NPYMagic = b'\x93NUMPY'
+
+# Reads the header of a .npy array, leaving f at the start of its data
+# Returns {'width', 'height', 'offset'}, or a message saying why if it isn't a 2-dimensional array of signed bytes in row order
+def parseNPYHeader(f):
+    if f.read(6) != NPYMagic:
+        return 'Not a valid .NPY file.'
+    major, minor = unpack('<2B', f.read(2))
+    lengthFormat = '<H'
+    if major > 1:
+        lengthFormat = '<I'
+    length, = unpack(lengthFormat, f.read(struct.calcsize(lengthFormat)))
+    try:
+        header = ast.literal_eval(f.read(length).decode('latin-1'))
+        descr = header['descr']
+        fortranOrder = header['fortran_order']
+        height, width = header['shape']
+    except (ValueError, SyntaxError, KeyError, TypeError):
+        return 'Not a valid .NPY file.'
+    if descr not in ['|i1', 'i1', '<i1', '>i1'] or fortranOrder:
+        return 'Only int8 .NPY arrays in row order are supported.'
+    return {'width':width, 'height':height, 'offset':f.tell()}
+
+# Like streamWNAMsFromPGM, for arrays written by extracting to .npy
+# .npy arrays are stored top row first, with each value being a WNAM byte as it is
+def streamWNAMsFromNPY(img, coords, header, cellWidth, cellHeight, scale=9, region=None):
+    try:
+        width = cellWidth * scale
+        bandSize = width * scale
+        table = orderedHeightTable(range(256))
+        for row in range(cellHeight):
+            y = coords[1] + cellHeight - 1 - row
+            if region is not None and not region[1] <= y <= region[3]:
+                continue
+            img.seek(header['offset'] + row * bandSize)
+            pixels = img.read(bandSize)
+            rows = [pixels[i:i + width] for i in range(0, len(pixels), width)]
+            rows.reverse()
+            if scale == 9:
+                WNAMs = WNAMsFromBand(b''.join(rows), cellWidth, width)
+            else:
+                WNAMs = WNAMsFromPixelRows([pixelRow.translate(table) for pixelRow in rows], cellWidth, scale, 255)
+            for x, WNAM in enumerate(WNAMs):
+                if inRegion((coords[0] + x, y), region):
+                    yield (coords[0] + x, y), WNAM
+    finally:
+        img.close()
+
+# Functions reading an image's header and streaming its cells, by extension
+# Header readers return at least {'width', 'height'}, or a message saying why the image can't be used
+# Streamers are given the open image, its header and its size in cells, and close the image once they're done
+imageReaders = {
+    '.bmp': (BMPInfo, streamWNAMsFromBMP),
+    '.pgm': (parsePGMHeader, streamWNAMsFromPGM),
+    '.png': (PNGInfo, streamWNAMsFromPNG),
+    '.npy': (parseNPYHeader, streamWNAMsFromNPY)
+}
 
-def BMPFromPixelArray(bmpPath, pixelArray, colored=False):
+# Returns the region covered by an image with its bottom left cell at coords, or a message saying why if it can't be used
+def imageRegion(imagePath, coords, scale=9):
+    with open(imagePath, mode='rb') as img:
+        header = imageReaders[os.path.splitext(imagePath)[1].lower()][0](img)
+    if isinstance(header, str):
+        return header
+    return (coords[0], coords[1], coords[0] + header['width'] // scale - 1, coords[1] + header['height'] // scale - 1)
+
+# Returns a generator of ((x, y), WNAM bytes) for each cell in the image, or a message saying why if it can't be used
+# The image is read one row of cells at a time, so memory use doesn't depend on its size
+# If region is set, only cells inside of it are read
+# Images with more than 9 pixels per cell side are averaged down to 9
+def WNAMsFromImage(imagePath, coords, region=None, scale=9):
+    readHeader, streamWNAMs = imageReaders[os.path.splitext(imagePath)[1].lower()]
+    img = open(imagePath, mode='rb')
+    header = readHeader(img)
+    if isinstance(header, str):
+        img.close()
+        return header
+
+    width = header['width']
+    height = header['height']
+    if width % scale > 0 or height % scale > 0:
+        img.close()
+        return 'Image dimensions must be divisible by {:d}.'.format(scale)
+
+    return streamWNAMs(img, coords, header, width // scale, height // scale, scale, region)
+
+# Returns [(image path, (x, y)), ...] for an image or a directory of tiles, where (x, y) is the bottom left cell each is named after
+# Files in a directory that aren't images named after a cell are ignored
+def imagesFromPath(imagePath):
+    paths = [imagePath]
+    if os.path.isdir(imagePath):
+        paths = [os.path.join(imagePath, item) for item in sorted(os.listdir(imagePath))
+            if os.path.splitext(item)[1].lower() in imageReaders]
+
+    images = []
+    for path in paths:
+        baseCoords = os.path.splitext(os.path.basename(path))[0].split(',')
+        try:
+            images.append((path, (int(baseCoords[0]), int(baseCoords[1]))))
+        except (ValueError, IndexError):
+            continue
+    return images
+
+# Returns the cells of an image whose WNAMs differ from WNAMs, keyed by (x, y), or a message saying why if it can't be read
+# WNAMs only needs to contain the cells the image covers; cells without one are compared to the seafloor
+# If digested is set, WNAMs contains WNAMDigests instead, and the image's cells are digested to compare them
+def changedWNAMsFromImage(imagePath, coords, WNAMs, region=None, digested=False, scale=9):
+    imageWNAMs = WNAMsFromImage(imagePath, coords, region, scale)
+    if isinstance(imageWNAMs, str):
+        return imageWNAMs
+    seafloor = pack('<b', -128) * 81
+    if digested:
+        seafloor = WNAMDigest(seafloor)
+    changedWNAMs = {}
+    for coords, WNAM in imageWNAMs:
+        if WNAMs.get(coords, seafloor) != (WNAMDigest(WNAM) if digested else WNAM):
+            changedWNAMs[coords] = WNAM
+    return changedWNAMs
+
+# Builds 9 padded pixel rows from a row of cell WNAMs, bottom row first like BMPs unless topDown is set
+# Each pixel column of a cell is copied across every cell at once with strided slices
+def bandFromWNAMs(WNAMs, padWidth, topDown=False):
+    width = len(WNAMs) * 9
+    cells = b''.join(WNAMs)
+    band = bytearray(padWidth * 9)
+    for row in range(9):
+        base = row * padWidth
+        if topDown:
+            base = (8 - row) * padWidth
+        for column in range(9):
+            band[base + column:base + width:9] = cells[row * 9 + column::81]
+    return band
+
+# Yields the padded bands of a map with (left, bottom) as its origin, bottom band first, or top band first if topDown is set
+# WNAMs are keyed by (x, y); only one band is built at a time
+# Cells without WNAMs are filled with the seafloor value, which is -128
+def mapBandsFromWNAMs(WNAMs, left, bottom, cellWidth, cellHeight, topDown=False):
+    padWidth = padLength(cellWidth * 9, 4)
+    seafloor = pack('<b', -128) * 81
+    seafloorBand = None
+
+    rows = cellRows(WNAMs)
+    cellYs = range(bottom, bottom + cellHeight)
+    if topDown:
+        cellYs = reversed(cellYs)
+    for y in cellYs:
+        if not y in rows:
+            if not seafloorBand:
+                seafloorBand = bytes(bandFromWNAMs([seafloor] * cellWidth, padWidth, topDown))
+            yield seafloorBand
+            continue
+        row = [seafloor] * cellWidth
+        for x in rows.pop(y):
+            row[x - left] = WNAMs[(x, y)]
+        yield bandFromWNAMs(row, padWidth, topDown)
+
+def BMPHeader(width, height):
+    padWidth = padLength(width, 4)
     b = bytearray()
     for itemName, item in baseBMPheader.items():
         itemFormat = item['format']
         value = item['value']
         if itemName == 'FileSize':
-            value = 0x436 + pixelArray.height * pixelArray.padWidth
+            value = 0x436 + height * padWidth
         elif itemName == 'Width':
-            value = pixelArray.width
+            value = width
         elif itemName == 'Height':
-            value = pixelArray.height
+            value = height
         elif itemName == 'ImageSize':
-            value = pixelArray.height * pixelArray.padWidth
+            value = height * padWidth
         b += pack(itemFormat, value)
-    if colored:
-        b += heightPaletteColor.to_bytes()
-    else:
-        b += heightPaletteMono.to_bytes()
-    b += pixelArray.value
+    return b
+
+# Writes padded pixel data as it's generated, so the whole image never has to be in memory
+def BMPFromBands(bmpPath, width, height, bands, colored=False):
     with open(bmpPath, mode='wb') as img:
-        img.write(b)
+        img.write(BMPHeader(width, height))
+        img.write(heightPalette(colored).to_bytes())
+        for band in bands:
+            img.write(band)
+
+def PNGChunk(tag, data):
+    chunk = tag.encode('ascii') + data
+    return pack('>I', len(data)) + chunk + pack('>I', zlib.crc32(chunk))
+
+# Writes an 8-bit paletted PNG, compressing padded pixel data as it's generated, with bands given top band first
+# Pixels are the same palette indices as in BMPs, so either can be repacked
+def PNGFromBands(pngPath, width, height, bands, colored=False):
+    padWidth = padLength(width, 4)
+    # PNG palettes are RGB, and BMP palettes are BGR
+    palette = b''.join(bytes([color[2], color[1], color[0]]) for color in heightPalette(colored).value)
+    compressor = zlib.compressobj()
+    with open(pngPath, mode='wb') as img:
+        img.write(PNGSignature)
+        img.write(PNGChunk('IHDR', pack('>2I5B', width, height, 8, 3, 0, 0, 0)))
+        img.write(PNGChunk('PLTE', palette))
+        for band in bands:
+            # Every row starts with its filter type, which is always none
+            data = b''.join(b'\x00' + band[base:base + width] for base in range(0, len(band), padWidth))
+            compressed = compressor.compress(data)
+            if compressed:
+                img.write(PNGChunk('IDAT', compressed))
+        img.write(PNGChunk('IDAT', compressor.flush()))
+        img.write(PNGChunk('IEND', b''))
+
+def NPYHeader(width, height):
+    header = '{{\'descr\': \'|i1\', \'fortran_order\': False, \'shape\': ({:d}, {:d}), }}'.format(height, width)
+    # Everything before the data is padded to a multiple of 64 bytes, ending with a newline
+    header += ' ' * (63 - (len(NPYMagic) + 4 + len(header)) % 64) + '\n'
+    return NPYMagic + pack('<2BH', 1, 0, len(header)) + header.encode('ascii')
+
+# Writes a .npy array of the unpadded pixel data as it's generated, with bands given top band first
+# Values are WNAM bytes as they are, so the array can be memory-mapped as int8 heights; it has no palette
+def NPYFromBands(npyPath, width, height, bands, colored=False):
+    padWidth = padLength(width, 4)
+    with open(npyPath, mode='wb') as img:
+        img.write(NPYHeader(width, height))
+        for band in bands:
+            img.write(b''.join(band[base:base + width] for base in range(0, len(band), padWidth)))
+
+# Functions writing an image from padded bands by extension, and whether they take them top band first
+imageWriters = {
+    '.bmp': (BMPFromBands, False),
+    '.png': (PNGFromBands, True),
+    '.npy': (NPYFromBands, True)
+}
 
 
 ######## Plugin/record handling ########
         
 
-def recordsFromPlugins(pluginDict, recordTags=False):
+# Reads the header and records of a single plugin
+# If lazy is set, the plugin is memory-mapped and subrecords are only copied when retrieved
+# LANDs with ids in resolved or outside of region are skipped without being read
+# If pluginName is set, records are named after it instead of the plugin's filename
+def recordsFromPlugin(pluginPath, recordTags=False, lazy=False, resolved=None, region=None, pluginName=None):
+    records = []
+    if lazy:
+        f = PluginView(pluginPath)
+    else:
+        f = open(pluginPath, mode='rb')
+    with f:
+        header = Record(f, pluginName=pluginName)
+        recordCount, = unpack('<296xI', header.getSubrecord('HEDR').data)
+        for num in range(recordCount):
+            record = Record(f, recordTags, resolved, region, pluginName)
+            if not record.passed:
+                records.append(record)
+    return header, records
+
+# Plugins are read in reverse load order so LANDs overridden by later plugins can be skipped
+# The result is the same as reading every record in load order
+def recordsFromPlugins(pluginDict, recordTags=False, lazy=False, stats=quietStats, region=None):
     records = {'TES3':{}}
-    for pluginName, pluginPath in pluginDict.items():
-        with open(pluginPath, mode='rb') as f:
-            header = Record(f)
+    pluginNames = list(pluginDict)
+    resolved = None
+    if not recordTags or 'LAND' in recordTags:
+        pluginNames.reverse()
+        resolved = set()
+
+    for pluginName in pluginNames:
+        stats.progress('Reading records from {}... '.format(pluginName), end='')
+        header, pluginRecords = recordsFromPlugin(pluginDict[pluginName], recordTags, lazy, resolved, region, pluginName)
+
+        if stats.enabled:
             recordCount, = unpack('<296xI', header.getSubrecord('HEDR').data)
-            records['TES3'][header.name] = header
+            stats.count('pluginsRead')
+            stats.count('bytesRead', os.path.getsize(pluginDict[pluginName]))
+            stats.count('recordsParsed', len(pluginRecords))
+            stats.count('recordsSkipped', recordCount - len(pluginRecords))
+            stats.count('subrecordsParsed', sum(len(record.subrecords) for record in pluginRecords))
+
+        # Later records in the same plugin still replace earlier ones
+        pluginRecords = [header] + pluginRecords
+        newRecords = {}
+        for record in pluginRecords:
+            if not record.tag in newRecords:
+                newRecords[record.tag] = {}
+            newRecords[record.tag][record.name] = record
+
+        # Records from plugins later in the load order take precedence
+        for tag, tagRecords in newRecords.items():
+            if not tag in records:
+                records[tag] = {}
+            if resolved is None:
+                records[tag].update(tagRecords)
+            else:
+                for key, record in tagRecords.items():
+                    if not key in records[tag]:
+                        records[tag][key] = record
 
-            print('Reading {:d} records from {}... '.format(recordCount, pluginName), end='')
-            
-            for num in range(recordCount):
-                record = Record(f, recordTags)
-                if not record.passed:
-                    if not record.tag in records:
-                        records[record.tag] = {}
-                            
-                    key = record.name
-                    records[record.tag][key] = record
+        if resolved is not None and 'LAND' in newRecords:
+            resolved.update(newRecords['LAND'])
 
-            print('Done.')
+        stats.progress('Done.')
 
-    print('')
+    stats.progress('')
     return records
 
-# Takes records as dictionary:
-# {
-#   'TAG':[Record, ...],
-#   ...
-# {
-def writePlugin(pluginPath, records):
-    with open(pluginPath, mode='wb') as f:
-        for recordTag in records:
-            for recordName in records[recordTag]:
-                record = records[recordTag][recordName]
-                f.write(record.pack())
-
-defaultLAND = Record({
-    'tag':'LAND',
-    'flags':0,
-    'subrecords':[
-        {'tag':'INTV', 'data':pack('<2i', 0, 0)},
-        {'tag':'DATA', 'data':pack('<I', 1)},
-        {'tag':'VNML', 'data':pack('>3b', 0, 0, 127) * 4225},
-        {'tag':'VHGT', 'data':pack('<f4225b3x', -256, *bytes(4225))},
-        {'tag':'WNAM', 'data':pack('<81b', *([-128] * 81))}
-    ]
-})
-
-def sanitizeLand(records):
+# Reads the records starting at each of the given offsets in a plugin, in file order
+def recordsFromOffsets(pluginPath, offsets, lazy=False, stats=quietStats):
+    records = []
+    if lazy:
+        f = PluginView(pluginPath)
+    else:
+        f = open(pluginPath, mode='rb')
+    with f:
+        for offset in sorted(offsets):
+            f.seek(offset)
+            record = Record(f)
+            records.append(record)
+            if stats.enabled:
+                stats.count('recordsParsed')
+                stats.count('subrecordsParsed', len(record.subrecords))
+                stats.count('bytesRead', f.tell() - offset)
+    return records
+
+# Writes records to a plugin as soon as they're finalized, instead of packing them all at once
+# The header's record count is patched in when the plugin is closed
+class PluginWriter():
+
+    def write(self, record):
+        self.f.write(record.pack())
+        self.recordCount += 1
+
+    def close(self):
+        self.f.seek(self.countOffset)
+        self.f.write(pack('<I', self.recordCount))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def __init__(self, pluginPath, header):
+        self.recordCount = 0
+        # The record count is the last field of HEDR
+        self.countOffset = 0x10
+        for subrecord in header.subrecords.values():
+            self.countOffset += 8
+            if subrecord.tag == 'HEDR':
+                self.countOffset += len(subrecord.data) - 4
+                break
+            self.countOffset += len(subrecord.data)
+        self.f = open(pluginPath, mode='wb')
+        self.f.write(header.pack())
+
+# Built the first time they're used, and never modified afterwards since records share their subrecords
+defaultLANDs = {}
+
+# Returns the LAND used for cells without landscape data
+# If keepSpec isn't set, VNML/VHGT are left out; this is technically wrong but doesn't cause any problems
+def defaultLAND(keepSpec=True):
+    if not keepSpec in defaultLANDs:
+        landRecord = Record({
+            'tag':'LAND',
+            'flags':0,
+            'subrecords':[
+                {'tag':'INTV', 'data':pack('<2i', 0, 0)},
+                {'tag':'DATA', 'data':pack('<I', 1)},
+                {'tag':'VNML', 'data':pack('>3b', 0, 0, 127) * 4225},
+                {'tag':'VHGT', 'data':pack('<f4225b3x', -256, *bytes(4225))},
+                {'tag':'WNAM', 'data':pack('<81b', *([-128] * 81))}
+            ]
+        })
+        if not keepSpec:
+            landRecord.delSubrecord('VNML')
+            landRecord.delSubrecord('VHGT')
+        defaultLANDs[keepSpec] = landRecord
+    return defaultLANDs[keepSpec]
+
+# LANDs without WNAMs are given the default LAND's terrain and WNAM
+# If keepTerrain is set, LANDs that have a VHGT keep their own terrain, and only get the default WNAM
+def sanitizeLand(records, keepSpec=True, keepTerrain=False):
+    default = defaultLAND(keepSpec)
     for coords in records:
         record = records[coords]
         if record.tag == 'LAND' and not record.getSubrecord('WNAM'):
             flags, = unpack('<I', record.getSubrecord('DATA').data)
             flags = flags | 1
             record.setSubrecord(Subrecord({'tag':'DATA', 'data':pack('<I', flags)}))
-            record.setSubrecord(defaultLAND.getSubrecord('VNML'))
-            record.setSubrecord(defaultLAND.getSubrecord('VHGT'))
-            record.setSubrecord(defaultLAND.getSubrecord('WNAM'))
+            if keepTerrain and record.getSubrecord('VHGT'):
+                record.setSubrecord(default.getSubrecord('WNAM'))
+                continue
+            record.setSubrecord(default.getSubrecord('VNML'))
+            record.setSubrecord(default.getSubrecord('VHGT'))
+            record.setSubrecord(default.getSubrecord('WNAM'))
             records[coords] = record
     return records
 
 
+######## Plugin index cache ########
+
+
+# Bump this whenever the index structure changes so old cache files are ignored
+indexVersion = 3
+
+# Plugin index structure:
+#{
+#    'name': plugin filename,
+#    'version': float from HEDR,
+#    'lands': {(x, y): (record offset, WNAM bytes or None), ...},
+#    'ltex': {LTEX index: DATA bytes as stored, ...},
+#    'cells': {(x, y), ...} for exterior CELLs
+#}
+# If region is set, LANDs outside of it are left out as soon as their coordinates are read
+def indexPlugin(pluginPath, region=None):
+    index = {'name':os.path.basename(pluginPath), 'version':None, 'lands':{}, 'ltex':{}, 'cells':set()}
+    with PluginView(pluginPath) as f:
+        header = Record(f)
+        hedr = header.getSubrecord('HEDR').data
+        index['version'], = unpack('<f', hedr[0:4])
+        recordCount, = unpack('<296xI', hedr)
+
+        for num in range(recordCount):
+            start = f.tell()
+            info = f.read(0x10)
+            if not info:
+                break
+            tag, size, flags = unpack('<4sI4xI', info)
+            end = start + 0x10 + size
+            if tag == 'LAND':
+                # Only read the subrecords we need, skipping over the rest
+                coords = None
+                WNAM = None
+                while f.tell() < end:
+                    subTag, subSize = unpack('<4sI', f.read(8))
+                    if subTag == 'INTV':
+                        coords = unpack('<2i', f.read(subSize))
+                        if not inRegion(coords, region):
+                            break
+                    elif subTag == 'WNAM':
+                        WNAM = bytes(f.read(subSize))
+                    else:
+                        f.seek(subSize, 1)
+                if inRegion(coords, region):
+                    index['lands'][coords] = (start, WNAM)
+            elif tag == 'LTEX':
+                # Texture paths aren't always ASCII, so DATA is kept as it is and written back unchanged
+                texIndex = None
+                texData = None
+                while f.tell() < end:
+                    subTag, subSize = unpack('<4sI', f.read(8))
+                    if subTag == 'INTV':
+                        texIndex, = unpack('<I', f.read(subSize))
+                    elif subTag == 'DATA':
+                        texData = bytes(f.read(subSize))
+                    else:
+                        f.seek(subSize, 1)
+                # LTEX without either can't be used
+                if texIndex is not None and texData is not None:
+                    index['ltex'][texIndex] = texData
+            elif tag == 'CELL':
+                # DATA comes right after NAME, so the references making up the rest of the record are never read
+                while f.tell() < end:
+                    subTag, subSize = unpack('<4sI', f.read(8))
+                    if subTag == 'DATA':
+                        cellFlags, gridX, gridY = unpack('<I2i', f.read(12))
+                        # Interior cells have the first flag set, and their grid position is meaningless
+                        if not cellFlags & 1:
+                            index['cells'].add((gridX, gridY))
+                        break
+                    f.seek(subSize, 1)
+            f.seek(end)
+
+    return index
+
+# Returns a copy of an index without the LANDs outside of region
+def regionIndex(index, region):
+    if region is None:
+        return index
+    index = dict(index)
+    index['lands'] = {coords:land for coords, land in index['lands'].items() if inRegion(coords, region)}
+    return index
+
+def indexCachePath(pluginPath, cacheDir):
+    key = os.path.normcase(os.path.abspath(pluginPath)).encode('utf-8')
+    return os.path.join(cacheDir, hashlib.sha1(key).hexdigest() + '.idx')
+
+# If cacheDir is set, indexes are reused as long as the plugin's size and modification time are unchanged
+# memo may be a dict that keeps indexes in memory the same way, for when the same load order is read repeatedly
+# If jobs is greater than 1, plugins that need to be indexed are read in that many processes
+# If region is set, the returned indexes only contain LANDs inside of it
+def pluginIndexes(pluginDict, cacheDir=False, jobs=1, stats=quietStats, memo=None, region=None):
+    indexes = {}
+    fileStats = {}
+    for pluginName, pluginPath in pluginDict.items():
+        stat = os.stat(pluginPath)
+        fileStats[pluginName] = stat
+        if memo is not None and pluginPath in memo:
+            size, mtime, index = memo[pluginPath]
+            if size == stat.st_size and mtime == stat.st_mtime_ns:
+                stats.count('pluginsCached')
+                indexes[pluginName] = index
+                continue
+
+        cached = None
+        if cacheDir:
+            try:
+                with open(indexCachePath(pluginPath, cacheDir), mode='rb') as f:
+                    cached = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+
+        if (cached and cached['indexVersion'] == indexVersion and cached['size'] == stat.st_size
+                and cached['mtime'] == stat.st_mtime_ns):
+            stats.progress('Using cached index for {}.'.format(pluginName))
+            stats.count('pluginsCached')
+            indexes[pluginName] = cached['index']
+            if memo is not None:
+                memo[pluginPath] = (stat.st_size, stat.st_mtime_ns, cached['index'])
+        else:
+            indexes[pluginName] = None
+
+    missing = [pluginName for pluginName, index in indexes.items() if index is None]
+    # Indexes that are kept for later have to be complete, so they can only be filtered afterwards
+    indexRegion = None
+    if not cacheDir and memo is None:
+        indexRegion = region
+
+    results = None
+    executor = None
+    if jobs > 1 and len(missing) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(jobs)
+        results = executor.map(indexPlugin, [pluginDict[pluginName] for pluginName in missing], itertools.repeat(indexRegion))
+
+    try:
+        for pluginName in missing:
+            pluginPath = pluginDict[pluginName]
+            stats.progress('Indexing records from {}... '.format(pluginName), end='')
+            if results:
+                index = next(results)
+            else:
+                index = indexPlugin(pluginPath, indexRegion)
+            stats.progress('Done.')
+            indexes[pluginName] = index
+            stat = fileStats[pluginName]
+            if memo is not None:
+                memo[pluginPath] = (stat.st_size, stat.st_mtime_ns, index)
+
+            if stats.enabled:
+                stats.count('pluginsRead')
+                stats.count('bytesRead', stat.st_size)
+                stats.count('recordsIndexed', len(index['lands']) + len(index['ltex']))
+
+            if not cacheDir:
+                continue
+            cached = {'indexVersion':indexVersion, 'size':stat.st_size, 'mtime':stat.st_mtime_ns, 'index':index}
+            os.makedirs(cacheDir, exist_ok=True)
+            cachePath = indexCachePath(pluginPath, cacheDir)
+            tempPath = cachePath + '.tmp'
+            with open(tempPath, mode='wb') as f:
+                pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempPath, cachePath)
+    finally:
+        if executor:
+            executor.shutdown()
+
+    stats.progress('')
+    if region is not None:
+        for pluginName, index in indexes.items():
+            indexes[pluginName] = regionIndex(index, region)
+    return indexes
+
+# Returns (plugin name, record offset, WNAM) for the LAND that ends up being used for each cell, keyed by (x, y)
+# Plugin names are the keys of pluginDict
+# With jobs greater than 1, plugins are indexed in that many processes, which only send back the LANDs' offsets and WNAMs
+def landsFromPlugins(pluginDict, lazy=False, cacheDir=False, jobs=1, stats=quietStats, region=None):
+    if cacheDir or (jobs > 1 and len(pluginDict) > 1):
+        with stats.phase('index'):
+            indexes = pluginIndexes(pluginDict, cacheDir, jobs, stats, None, region)
+        return landsFromIndexes(indexes)
+
+    lands = {}
+    with stats.phase('parse'):
+        landRecords = recordsFromPlugins(pluginDict, ['LAND'], lazy, stats, region).get('LAND', {})
+    with stats.phase('sanitize'):
+        landRecords = sanitizeLand(landRecords)
+    for coords, landRecord in landRecords.items():
+        lands[coords] = (landRecord.pluginName, landRecord.offset, landRecord.getSubrecord('WNAM').data)
+    return lands
+
+
+# Returns (plugin name, record offset, WNAM) for the LAND that ends up being used for each cell, keyed by (x, y)
+def landsFromIndexes(indexes):
+    lands = {}
+    defaultWNAM = defaultLAND().getSubrecord('WNAM').data
+    for pluginName, index in indexes.items():
+        for coords, (offset, WNAM) in index['lands'].items():
+            lands[coords] = (pluginName, offset, WNAM or defaultWNAM)
+    return lands
+
+
+######## Image sidecars ########
+
+
+# Bump this whenever the sidecar structure changes so old sidecars are ignored
+sidecarVersion = 2
+
+# Sidecars are JSON, since they're shared along with images and can't be trusted the way the index cache is
+# Sidecar structure:
+#{
+#    'sidecarVersion': sidecarVersion,
+#    'fingerprint': loadOrderFingerprint of the plugins the image was extracted from,
+#    'region': [left, bottom, right, top] of cells whose LANDs were all read when extracting,
+#    'cells': [[x, y, WNAM digest as hex, plugin name, record offset], ...]
+#}
+# Cells in the region without a LAND are left out, and are seafloor in the image
+
+def WNAMDigest(WNAM):
+    return hashlib.blake2b(WNAM, digest_size=8).digest()
+
+# Changes whenever plugins are added, removed, reordered or modified
+def loadOrderFingerprint(pluginDict):
+    h = hashlib.sha1()
+    for pluginName, pluginPath in pluginDict.items():
+        stat = os.stat(pluginPath)
+        h.update('{}\0{:d}\0{:d}\0'.format(pluginName.lower(), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+def sidecarPath(bmpPath):
+    return os.path.splitext(bmpPath)[0] + '.digests'
+
+# lands is structured like the result of landsFromPlugins, and may contain cells outside of region
+def writeSidecar(bmpPath, fingerprint, region, lands):
+    cells = []
+    for (x, y), (pluginName, offset, WNAM) in sorted(lands.items()):
+        if inRegion((x, y), region):
+            cells.append([x, y, WNAMDigest(WNAM).hex(), pluginName, offset])
+    sidecar = {'sidecarVersion':sidecarVersion, 'fingerprint':fingerprint, 'region':list(region), 'cells':cells}
+    with open(sidecarPath(bmpPath), mode='w', encoding='utf-8') as f:
+        json.dump(sidecar, f, separators=(',', ':'))
+
+# Returns the cells of an image's sidecar if it was extracted from the same load order and covers imageRegion, otherwise None
+# Cells are returned as {(x, y): (WNAM digest, plugin name, record offset), ...}
+# Sidecars that aren't structured as expected are treated like missing ones
+def readSidecar(bmpPath, fingerprint, imageRegion):
+    try:
+        with open(sidecarPath(bmpPath), mode='r', encoding='utf-8') as f:
+            sidecar = json.load(f)
+        if sidecar.get('sidecarVersion') != sidecarVersion or sidecar['fingerprint'] != fingerprint:
+            return None
+        left, bottom, right, top = map(int, sidecar['region'])
+        region = (left, bottom, right, top)
+        if not (inRegion(imageRegion[:2], region) and inRegion(imageRegion[2:], region)):
+            return None
+        cells = {}
+        for x, y, digest, pluginName, offset in sidecar['cells']:
+            cells[(int(x), int(y))] = (bytes.fromhex(digest), str(pluginName), int(offset))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+    return cells
+
+
+######## Heightmaps ########
+
+
+# VHGT is a float offset followed by 65 rows of 65 signed deltas, bottom row first, then 3 unused bytes
+# The first delta of each row is relative to the start of the row below it, and every other delta to the vertex before it
+# Returns the heights of the vertices in game units, which are 8 times the stored values, as an array of floats
+# If step is set, only every step-th vertex of every step-th row is returned, starting with the first
+def heightsFromVHGT(VHGT, step=1):
+    offset, = unpack('<f', VHGT[0:4])
+    deltas = array.array('b')
+    deltas.frombytes(VHGT[4:4229])
+    heights = []
+    # Running sums down the first column give where each row starts, and running sums along each row give the rest
+    rowStarts = list(itertools.accumulate(deltas[0::65], initial=offset))
+    for row in range(0, 65, step):
+        base = row * 65
+        rowHeights = itertools.accumulate(deltas[base + 1:base + 65], initial=rowStarts[row + 1])
+        heights.extend(itertools.islice(rowHeights, 0, None, step))
+    # Arrays are built much faster from lists than from iterators
+    return array.array('f', list(map(operator.mul, heights, itertools.repeat(8.0))))
+
+# Game units of height per step of WNAM
+WNAMHeightScale = 128
+
+# Returns the WNAM matching a VHGT, made from every 8th vertex of every 8th row, so the corners and edges of cells line up
+# Heights are scaled down and clamped to a signed byte
+def WNAMFromVHGT(VHGT):
+    heights = heightsFromVHGT(VHGT, 8)
+    return pack('<81b', *[min(max(math.floor(height / WNAMHeightScale), -128), 127) for height in heights])
+
+# Returns the WNAMs matching the VHGTs of the LANDs at the given offsets in a plugin, keyed by (x, y)
+# LANDs without VHGTs are left out, since their terrain isn't known
+def WNAMsFromVHGTs(pluginPath, offsets, lazy=False):
+    WNAMs = {}
+    for landRecord in recordsFromOffsets(pluginPath, offsets, lazy):
+        VHGT = landRecord.getSubrecord('VHGT')
+        if VHGT:
+            WNAMs[landRecord.id] = WNAMFromVHGT(VHGT.data)
+    return WNAMs
+
+# Builds the 64 pixel rows of a row of cells from their heights, bottom row first
+# The last row and column of each cell are left out, since they're the same vertices as the first of the next cell
+def bandFromHeights(heights):
+    band = array.array('f')
+    for row in range(64):
+        base = row * 65
+        for cellHeights in heights:
+            band.extend(cellHeights[base:base + 64])
+    # PFM images with a negative scale are little-endian
+    if sys.byteorder == 'big':
+        band.byteswap()
+    return band.tobytes()
+
+# Yields the bands of a heightmap with (left, bottom) as its origin, bottom band first, reading one row of LANDs at a time
+# lands is keyed by (x, y) like the result of landsFromPlugins; cells without LANDs or VHGTs get the default LAND's heights
+def mapBandsFromLands(pluginDict, lands, left, bottom, cellWidth, cellHeight, lazy=False, stats=quietStats):
+    defaultHeights = heightsFromVHGT(defaultLAND().getSubrecord('VHGT').data)
+    defaultBand = None
+
+    rows = cellRows(lands)
+    for y in range(bottom, bottom + cellHeight):
+        if not y in rows:
+            if not defaultBand:
+                defaultBand = bandFromHeights([defaultHeights] * cellWidth)
+            yield defaultBand
+            continue
+
+        landOffsets = {}
+        for x in rows.pop(y):
+            landPlugin, offset, WNAM = lands[(x, y)]
+            if not landPlugin in landOffsets:
+                landOffsets[landPlugin] = []
+            landOffsets[landPlugin].append(offset)
+
+        row = [defaultHeights] * cellWidth
+        for landPlugin, offsets in landOffsets.items():
+            for landRecord in recordsFromOffsets(pluginDict[landPlugin], offsets, lazy, stats):
+                VHGT = landRecord.getSubrecord('VHGT')
+                if VHGT:
+                    row[landRecord.id[0] - left] = heightsFromVHGT(VHGT.data)
+        yield bandFromHeights(row)
+
+def PFMHeader(width, height):
+    return 'Pf\n{:d} {:d}\n-1.0\n'.format(width, height).encode('ascii')
+
+
 ######## Main mode functions ########
 
 
-def pluginsToBMP(pluginList, bmpDir, colored=False):
-    landRecords = recordsFromPlugins(pluginList, ['LAND'])['LAND']
-    landRecords = sanitizeLand(landRecords)
-    if len(landRecords) <= 0:
+# If region is set, only the LANDs inside of it are extracted
+# If tileSize is set, the map is split into tiles of that many cells per side instead, aligned to multiples of tileSize
+# A sidecar is written next to each image so repacking can tell which cells changed without reading the load order
+# imageFormat is the extension of one of imageWriters
+def pluginsToBMP(pluginList, bmpDir, colored=False, lazy=False, cacheDir=False, jobs=1, stats=quietStats, region=None, tileSize=None,
+        imageFormat='.bmp'):
+    lands = landsFromPlugins(pluginList, lazy, cacheDir, jobs, stats, region)
+    if len(lands) <= 0:
+        if region is not None:
+            return 'Couldn\'t find any LAND records in the given region.'
         return 'Couldn\'t find any LAND records in the provided plugin(s).'
+    fingerprint = loadOrderFingerprint(pluginList)
+    landWNAMs = {coords:WNAM for coords, (pluginName, offset, WNAM) in lands.items()}
+
+    if tileSize:
+        return tilesFromWNAMs(landWNAMs, bmpDir, tileSize, colored, stats, lands, fingerprint, imageFormat, region)
 
     # Calculate bounding rectangle surrounding all LANDs
-    left = right = top = bottom = None
-    for coords in landRecords:
-        coords = coords.split(',')
-        x = int(coords[0])
-        y = int(coords[1])
-        left = min(x, left or x)
-        right = max(x, right or x)
-        bottom = min(y, bottom or y)
-        top = max(y, top or y)
+    left, bottom, right, top = boundingRegion(landWNAMs)
 
     # Actual width/height are 1 more than bounding dimensions
     cellWidth = right - left + 1
     cellHeight = top - bottom + 1
-    
-    width = cellWidth * 9
-    height = cellHeight * 9
-    padWidth = padLength(width, 4)
 
-    # Initialize image as seafloor value, which is -128
-    mapArray = (pack('<b', -128) * width + bytearray(padWidth-width)) * height
-    mapArray = PixelArray(mapArray, width, height, padWidth)
-    
-    for x in range(cellWidth):
-        worldX = x + left
-        for y in range(cellHeight):
-            worldY = y + bottom
-            key = str(worldX) + ',' + str(worldY)
-            b = None
-            if key in landRecords:
-                b = landRecords[key].getSubrecord('WNAM').data
-                cellArray = PixelArray(b, 9, 9, 9)
-                mapArray.impose(cellArray, x*9, y*9)
-    bmpName = '{:d},{:d}.bmp'.format(left, bottom)
+    writer, topDown = imageWriters[imageFormat]
+    bands = mapBandsFromWNAMs(landWNAMs, left, bottom, cellWidth, cellHeight, topDown)
+    bmpName = '{:d},{:d}{}'.format(left, bottom, imageFormat)
     bmpPath = os.path.join(bmpDir, bmpName)
-    BMPFromPixelArray(bmpPath, mapArray, colored)
-    return 'Converted {:d} WNAMs to BMP at "{}"'.format(len(landRecords), bmpPath)
-
-def BMPToPlugin(mastersDict, bmpPath, pluginPath, noCells=False, keepSpec=False):
-    # Leaving these out is technically wrong but doesn't cause any problems
-    if not keepSpec:
-        defaultLAND.delSubrecord('VNML')
-        defaultLAND.delSubrecord('VHGT')
-        
-    baseCoords = os.path.splitext(os.path.basename(bmpPath))[0].split(',')
-    x = None
-    y = None
-    try:
-        x = int(baseCoords[0])
-        y = int(baseCoords[1])
-    except:
+    with stats.phase('write'):
+        writer(bmpPath, cellWidth * 9, cellHeight * 9, bands, colored)
+        writeSidecar(bmpPath, fingerprint, (left, bottom, right, top), lands)
+    stats.count('cellsWritten', len(landWNAMs))
+    stats.count('bytesWritten', os.path.getsize(bmpPath))
+    return 'Converted {:d} WNAMs to {} at "{}"'.format(len(landWNAMs), imageFormat[1:].upper(), bmpPath)
+
+# Writes the height of every vertex in the load order to a PFM image, 64 pixels per cell
+# Cells are placed the same way as in pluginsToBMP, and the image is written one row of cells at a time
+# LANDs are located through plugin indexes, so none are read in full until their row is written
+def pluginsToPFM(pluginList, pfmDir, lazy=False, cacheDir=False, jobs=1, stats=quietStats, region=None):
+    with stats.phase('index'):
+        indexes = pluginIndexes(pluginList, cacheDir, jobs, stats, None, region)
+    lands = landsFromIndexes(indexes)
+    if len(lands) <= 0:
+        if region is not None:
+            return 'Couldn\'t find any LAND records in the given region.'
+        return 'Couldn\'t find any LAND records in the provided plugin(s).'
+
+    left, bottom, right, top = boundingRegion(lands)
+    cellWidth = right - left + 1
+    cellHeight = top - bottom + 1
+
+    bands = mapBandsFromLands(pluginList, lands, left, bottom, cellWidth, cellHeight, lazy, stats)
+    pfmPath = os.path.join(pfmDir, '{:d},{:d}.pfm'.format(left, bottom))
+    with stats.phase('write'), open(pfmPath, mode='wb') as img:
+        img.write(PFMHeader(cellWidth * 64, cellHeight * 64))
+        for band in bands:
+            img.write(band)
+    stats.count('cellsWritten', len(lands))
+    stats.count('bytesWritten', os.path.getsize(pfmPath))
+    return 'Converted {:d} heightmaps to PFM at "{}"'.format(len(lands), pfmPath)
+
+# Tiles where every cell is seafloor are left out, since repacking them wouldn't change anything
+# If lands and fingerprint are given, each tile gets a sidecar
+# If region is set, tiles are cropped to it, since LANDs outside of it weren't read and would otherwise be seafloor
+def tilesFromWNAMs(landWNAMs, bmpDir, tileSize, colored=False, stats=quietStats, lands=None, fingerprint=None, imageFormat='.bmp',
+        region=None):
+    seafloor = pack('<b', -128) * 81
+    tiles = {}
+    for (x, y), WNAM in landWNAMs.items():
+        tile = (x // tileSize * tileSize, y // tileSize * tileSize)
+        if not tile in tiles:
+            tiles[tile] = {}
+        tiles[tile][(x, y)] = WNAM
+
+    writer, topDown = imageWriters[imageFormat]
+    numTiles = 0
+    with stats.phase('write'):
+        for (tileLeft, tileBottom), tileWNAMs in sorted(tiles.items()):
+            if all(WNAM == seafloor for WNAM in tileWNAMs.values()):
+                stats.count('tilesSkipped')
+                continue
+            tileRegion = (tileLeft, tileBottom, tileLeft + tileSize - 1, tileBottom + tileSize - 1)
+            left, bottom, right, top = regionIntersection(tileRegion, region)
+            cellWidth = right - left + 1
+            cellHeight = top - bottom + 1
+            bands = mapBandsFromWNAMs(tileWNAMs, left, bottom, cellWidth, cellHeight, topDown)
+            bmpPath = os.path.join(bmpDir, '{:d},{:d}{}'.format(left, bottom, imageFormat))
+            writer(bmpPath, cellWidth * 9, cellHeight * 9, bands, colored)
+            if lands:
+                writeSidecar(bmpPath, fingerprint, (left, bottom, right, top), {coords:lands[coords] for coords in tileWNAMs})
+            numTiles += 1
+            stats.count('cellsWritten', len(tileWNAMs))
+            stats.count('bytesWritten', os.path.getsize(bmpPath))
+    return 'Converted {:d} WNAMs to {:d} {} tiles in "{}"'.format(len(landWNAMs), numTiles, imageFormat[1:].upper(), bmpDir)
+
+# bmpPath may be an image or a directory of tiles, which are read in jobs processes at once
+# Only cells inside both the images and region are repacked
+# scale is the number of pixels per cell side in the images
+# If removeUnchanged is set and no cells changed, a previous plugin at pluginPath is removed
+def BMPToPlugin(mastersDict, bmpPath, pluginPath, noCells=False, keepSpec=False, lazy=False, jobs=1, cacheDir=False, stats=quietStats,
+        memo=None, region=None, scale=9, removeUnchanged=False):
+    # Each of the 9 boxes a cell side is averaged down to has to be at least a pixel wide
+    if scale < 9:
+        return 'Images must have at least 9 pixels per cell side.'
+    if not os.path.exists(bmpPath):
+        return 'Couldn\'t find an image or tile directory at "{}".'.format(bmpPath)
+    if not os.path.isdir(bmpPath) and not os.path.splitext(bmpPath)[1].lower() in imageReaders:
+        return 'Images can only be repacked from {}.'.format(', '.join(imageReaders))
+
+    images = imagesFromPath(bmpPath)
+    if not images:
+        if os.path.isdir(bmpPath):
+            return 'Couldn\'t find any images named according to a cell coordinate. [x,y]'
         return 'The image isn\'t named according to a cell coordinate. [x,y]'
-    
-    imageWNAMs = WNAMsFromBMP(bmpPath, (x,y))
-    
-    oldRecords = recordsFromPlugins(mastersDict, ['TES3', 'LAND', 'LTEX'])
-    newRecords = {'TES3':{}, 'LTEX':{}, 'LAND':{}, 'CELL':{}}
-    
-    oldLandRecords = sanitizeLand(oldRecords['LAND'])
-    oldTexRecords = oldRecords['LTEX']
-    texPaths = []
+
+    imageRegions = []
+    for imagePath, coords in images:
+        coveredRegion = imageRegion(imagePath, coords, scale)
+        if isinstance(coveredRegion, str):
+            return 'Couldn\'t read heightmaps from "{}". {}'.format(imagePath, coveredRegion)
+        imageRegions.append(regionIntersection(coveredRegion, region))
+
+    # If every image has a sidecar from extracting this load order, cells are compared to the digests in them
+    # Otherwise, only the locations and WNAMs of LANDs are needed to tell which cells changed
+    # LANDs the images don't cover can't have changed, so they're left out
+    fingerprint = loadOrderFingerprint(mastersDict)
+    sidecars = [readSidecar(imagePath, fingerprint, coveredRegion) for (imagePath, coords), coveredRegion in zip(images, imageRegions)]
+    # Plugin names are checked too, since the fingerprint doesn't tell apart names that only differ in case
+    digested = all(cells is not None and all(land[1] in mastersDict for land in cells.values()) for cells in sidecars)
+    indexes = None
+    if digested:
+        lands = {}
+        for cells in sidecars:
+            for coords, (digest, pluginName, offset) in cells.items():
+                lands[coords] = (pluginName, offset, digest)
+    else:
+        indexRegion = (min(r[0] for r in imageRegions), min(r[1] for r in imageRegions),
+            max(r[2] for r in imageRegions), max(r[3] for r in imageRegions))
+        with stats.phase('index'):
+            indexes = pluginIndexes(mastersDict, cacheDir, jobs, stats, memo, indexRegion)
+        lands = landsFromIndexes(indexes)
+
+    # Only keep cells that differ from the load order while each image is read
+    # Each tile is only sent the WNAMs of the cells it covers
+    landWNAMs = []
+    for left, bottom, right, top in imageRegions:
+        tileWNAMs = {}
+        for coords in itertools.product(range(left, right + 1), range(bottom, top + 1)):
+            if coords in lands:
+                tileWNAMs[coords] = lands[coords][2]
+        landWNAMs.append(tileWNAMs)
+
+    changedWNAMs = {}
+    results = None
+    executor = None
+    with stats.phase('decode image'):
+        if jobs > 1 and len(images) > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(jobs)
+            results = executor.map(changedWNAMsFromImage, [imagePath for imagePath, coords in images],
+                [coords for imagePath, coords in images], landWNAMs, itertools.repeat(region), itertools.repeat(digested),
+                itertools.repeat(scale))
+        try:
+            # Where tiles overlap, the last one by name takes precedence
+            for num, (imagePath, coords) in enumerate(images):
+                if results:
+                    imageChanges = next(results)
+                else:
+                    imageChanges = changedWNAMsFromImage(imagePath, coords, landWNAMs[num], region, digested, scale)
+                if isinstance(imageChanges, str):
+                    return 'Couldn\'t read heightmaps from "{}". {}'.format(imagePath, imageChanges)
+                changedWNAMs.update(imageChanges)
+
+                if stats.enabled:
+                    coveredRegion = imageRegions[num]
+                    stats.count('cellsRead', max(coveredRegion[2] - coveredRegion[0] + 1, 0) * max(coveredRegion[3] - coveredRegion[1] + 1, 0))
+                    stats.count('bytesRead', os.path.getsize(imagePath))
+        finally:
+            if executor:
+                executor.shutdown()
+
+    return WNAMsToPlugin(mastersDict, changedWNAMs, lands, indexes, pluginPath, noCells, keepSpec, lazy, jobs, cacheDir, stats, memo,
+        removeUnchanged=removeUnchanged)
+
+# LANDs are sent to be regenerated in batches of this many per plugin
+regenerateBatchSize = 1024
+
+# Computes the WNAM of every LAND in the load order from its VHGT, and writes a plugin with those that differ from the current ones
+# Batches of LANDs are handled in jobs processes at once
+# If region is set, only the LANDs inside of it are regenerated
+def regenerateToPlugin(mastersDict, pluginPath, noCells=False, keepSpec=False, lazy=False, jobs=1, cacheDir=False, stats=quietStats,
+        memo=None, region=None):
+    with stats.phase('index'):
+        indexes = pluginIndexes(mastersDict, cacheDir, jobs, stats, memo, region)
+    lands = landsFromIndexes(indexes)
+    if len(lands) <= 0:
+        if region is not None:
+            return 'Couldn\'t find any LAND records in the given region.'
+        return 'Couldn\'t find any LAND records in the provided plugin(s).'
+
+    landOffsets = {}
+    for coords in sorted(lands):
+        landPlugin, offset, WNAM = lands[coords]
+        if not landPlugin in landOffsets:
+            landOffsets[landPlugin] = []
+        landOffsets[landPlugin].append(offset)
+    batches = []
+    for landPlugin, offsets in landOffsets.items():
+        for start in range(0, len(offsets), regenerateBatchSize):
+            batches.append((mastersDict[landPlugin], offsets[start:start + regenerateBatchSize]))
+
+    changedWNAMs = {}
+    results = None
+    executor = None
+    with stats.phase('regenerate'):
+        if jobs > 1 and len(batches) > 1:
+            # Only WNAMs are sent back, so workers can memory-map plugins too
+            executor = concurrent.futures.ProcessPoolExecutor(jobs)
+            results = executor.map(WNAMsFromVHGTs, [pluginPath for pluginPath, offsets in batches],
+                [offsets for pluginPath, offsets in batches], itertools.repeat(lazy))
+        try:
+            for landPath, offsets in batches:
+                if results:
+                    WNAMs = next(results)
+                else:
+                    WNAMs = WNAMsFromVHGTs(landPath, offsets, lazy)
+                stats.count('cellsRead', len(offsets))
+                for coords, WNAM in WNAMs.items():
+                    if WNAM != lands[coords][2]:
+                        changedWNAMs[coords] = WNAM
+        finally:
+            if executor:
+                executor.shutdown()
+
+    if not changedWNAMs:
+        return 'Every WNAM already matches its terrain. No plugin will be generated.'
+    # WNAMs were computed from the terrain of these LANDs, so it has to be kept as it is
+    return WNAMsToPlugin(mastersDict, changedWNAMs, lands, indexes, pluginPath, noCells, keepSpec, lazy, jobs, cacheDir, stats, memo,
+        keepTerrain=True)
+
+# Writes a plugin at pluginPath giving each cell in changedWNAMs, keyed by (x, y), its new WNAM
+# lands holds the (plugin name, record offset, WNAM) of each LAND in the load order that a changed cell might have
+# If indexes is None, only the plugins that are needed are indexed
+# If keepTerrain is set, changed LANDs without WNAMs keep their VHGT and VNML instead of getting the default terrain
+# If removeUnchanged is set and no cells changed, a previous plugin at pluginPath is removed
+def WNAMsToPlugin(mastersDict, changedWNAMs, lands, indexes, pluginPath, noCells=False, keepSpec=False, lazy=False, jobs=1, cacheDir=False,
+        stats=quietStats, memo=None, keepTerrain=False, removeUnchanged=False):
+    default = defaultLAND(keepSpec)
+    texRecords = []
+    # Maps LTEX DATA to new LTEX indices
+    texPaths = {}
+    # Maps each master's VTEX indices to new VTEX indices, filled in as they're encountered
+    texTables = {}
 
     version, = unpack('<f', pack('<f', 1.2))
     # Use capitalized filenames here so MAST subrecords will match plugins used
@@ -599,130 +1861,311 @@ def BMPToPlugin(mastersDict, bmpPath, pluginPath, noCells=False, keepSpec=False)
     }
     newMasters = {}
 
-    for coords, imageWNAM in imageWNAMs.items():
-        landRecord = None
-        # New landscapes not from plugins
-        if not coords in oldLandRecords:
-            if imageWNAM.data != pack('<b', -128) * 81:
-                x, y = coords.split(',')
-                coordSubrecord = Subrecord({'tag':'INTV', 'data':pack('<2i', int(x), int(y))})
-                landRecord = Record({
-                    'tag':'LAND',
-                    'flags':0,
-                    'subrecords':[
-                        coordSubrecord,
-                        defaultLAND.getSubrecord('DATA'),
-                        defaultLAND.getSubrecord('VNML'),
-                        defaultLAND.getSubrecord('VHGT'),
-                        imageWNAM
-                    ]
-                })
-
-                # Morrowind.exe won't display WNAMs for grid squares without CELL records
-                # OpenMW won't expand the map for grid squares without CELL records
-                # However, including these prevents automatic fish spawning
-                if not noCells:
-                    cellName = Subrecord({'tag':'NAME', 'data':bytearray(1)})
-                    cellData = Subrecord({'tag':'DATA', 'data':pack('<I2i', 2, int(x), int(y))})
-                    newRecords['CELL'][coords] = Record({
-                        'tag':'CELL',
-                        'flags':0,
-                        'subrecords':[
-                            cellName,
-                            cellData
-                        ]
-                    })
-
-        # Pre-existing landscapes from plugins
-        else:
-            oldLandRecord = oldLandRecords[coords]
-            oldWNAM = oldLandRecord.getSubrecord('WNAM')
-            if oldWNAM.data != imageWNAM.data:
-                landRecord = oldLandRecord
-                landRecord.setSubrecord(imageWNAM)
-                
-                # Add dependencies for plugins whose WNAMs were changed
-                # Base game/expansion dependencies are added automatically
-                masterName = landRecord.plugin['name']
-                masterPath = mastersDict[masterName.lower()]
-                masterHeader = oldRecords['TES3'][masterName.lower()]
-                masterVersion, = unpack('<f', masterHeader.getSubrecord('HEDR').data[0:4])
-                if masterVersion > version:
-                    version = masterVersion
-                    masters['Tribunal.esm'] = 4565686
-                    masters['Bloodmoon.esm'] = 9631798
-                if not masterName.lower() in [n.lower() for n in masters]:
-                    newMasters[masterName] = os.path.getsize(masterPath)
-
-                # Handle land textures
-                oldVTEX = landRecord.getSubrecord('VTEX')
-                if oldVTEX:
-                    newTexNums = []
-                    oldTexNums = list(unpack('<256H', oldVTEX.data))
-                    for index in oldTexNums:
-                        # Beware, VTEX indices are +1 from LTEX indices
-                        # Index 0 always denotes default land texture
-                        if index == 0:
-                            newTexNums.append(0)
-                        else:
-                            oldTexRecord = oldTexRecords[masterName + ' ' + str(index - 1)]
-                            path = oldTexRecord.getSubrecord('DATA').data
-                            path, = unpack('<#sx', path)
-                            # Only keep one LTEX for each land texture, even if it exists in multiple plugins
-                            if not path in texPaths:
-                                newTexRecord = Record({
-                                    'tag':'LTEX',
-                                    'flags':0,
-                                    'subrecords':[
-                                        # Things break if LTEX don't have unique names
-                                        {'tag':'NAME', 'data':pack('<#sx', 'WNAMFalsified{:d}'.format(len(texPaths)))},
-                                        {'tag':'INTV', 'data':pack('<I', len(texPaths))},
-                                        {'tag':'DATA', 'data':pack('<#sx', path)}
-                                    ]
-                                })
-                                newRecords['LTEX'][newTexRecord.name] = newTexRecord
-                                texPaths.append(path)
-                                
-                            newTexNums.append(texPaths.index(path)+1)
-
-                    newVTEX = Subrecord({'tag':'VTEX', 'data':pack('<256H', *newTexNums)})
-                    landRecord.setSubrecord(newVTEX)
-                    
-        if landRecord:
-            newRecords['LAND'][coords] = landRecord  
+    changedCoords = sorted(changedWNAMs)
+    stats.count('cellsChanged', len(changedCoords))
+
+    # With sidecars, only the plugins that own changed cells are indexed, for their versions and land textures
+    # Any plugin could have a CELL for a new LAND though, so every plugin is indexed if CELLs might be created
+    if indexes is None:
+        owners = {lands[coords][0] for coords in changedCoords if coords in lands}
+        if not noCells and any(coords not in lands for coords in changedCoords):
+            owners = set(mastersDict)
+        ownerRegion = (0, 0, -1, -1)
+        if changedCoords:
+            ownerRegion = boundingRegion(changedCoords)
+        with stats.phase('index'):
+            indexes = pluginIndexes({pluginName:pluginPath for pluginName, pluginPath in mastersDict.items() if pluginName in owners},
+                cacheDir, jobs, stats, memo, ownerRegion)
+
+    # Then only the LANDs of changed cells are read in full
+    landOffsets = {}
+    for coords in changedCoords:
+        if coords in lands:
+            landPlugin, offset, WNAM = lands[coords]
+            if not landPlugin in landOffsets:
+                landOffsets[landPlugin] = []
+            landOffsets[landPlugin].append(offset)
+
+    oldLandRecords = {}
+    with stats.phase('parse'):
+        for landPlugin, offsets in landOffsets.items():
+            for landRecord in recordsFromOffsets(mastersDict[landPlugin], offsets, lazy, stats):
+                oldLandRecords[landRecord.id] = landRecord
+    with stats.phase('sanitize'):
+        oldLandRecords = sanitizeLand(oldLandRecords, keepSpec, keepTerrain)
+
+    # Changes to existing LANDs are made first, since the LTEX records they use must be written before them
+    # Cells are handled in the same order regardless of how the image was read
+    with stats.phase('remap textures'):
+        for coords in changedCoords:
+            if not coords in oldLandRecords:
+                continue
+
+            landRecord = oldLandRecords[coords]
+            landRecord.setSubrecord(Subrecord({'tag':'WNAM', 'data':changedWNAMs[coords]}))
+        
+            # Add dependencies for plugins whose WNAMs were changed
+            # Base game/expansion dependencies are added automatically
+            masterPath = mastersDict[lands[coords][0]]
+            masterName = os.path.basename(masterPath)
+            masterIndex = indexes[lands[coords][0]]
+            masterVersion = masterIndex['version']
+            if masterVersion > version:
+                version = masterVersion
+                masters['Tribunal.esm'] = 4565686
+                masters['Bloodmoon.esm'] = 9631798
+            if not masterName.lower() in [n.lower() for n in masters]:
+                newMasters[masterName] = os.path.getsize(masterPath)
+
+            # Handle land textures
+            oldVTEX = landRecord.getSubrecord('VTEX')
+            if oldVTEX:
+                # Beware, VTEX indices are +1 from LTEX indices
+                # Index 0 always denotes default land texture
+                if not masterName in texTables:
+                    texTables[masterName] = {0:0}
+                texTable = texTables[masterName]
+
+                oldTexNums = array.array('H', oldVTEX.data)
+                if sys.byteorder == 'big':
+                    oldTexNums.byteswap()
+
+                # Only indices this master's table hasn't seen yet need to be looked up, in order of appearance
+                for index in dict.fromkeys(oldTexNums):
+                    if index in texTable:
+                        continue
+                    texData = masterIndex['ltex'].get(index - 1)
+                    # Textures without a usable LTEX are shown as the default land texture
+                    if texData is None:
+                        texTable[index] = 0
+                        continue
+                    # Only keep one LTEX for each land texture, even if it exists in multiple plugins
+                    if not texData in texPaths:
+                        newTexRecord = Record({
+                            'tag':'LTEX',
+                            'flags':0,
+                            'subrecords':[
+                                # Things break if LTEX don't have unique names
+                                {'tag':'NAME', 'data':pack('<#sx', 'WNAMFalsified{:d}'.format(len(texPaths)))},
+                                {'tag':'INTV', 'data':pack('<I', len(texPaths))},
+                                {'tag':'DATA', 'data':texData}
+                            ]
+                        })
+                        texRecords.append(newTexRecord)
+                        texPaths[texData] = len(texPaths)
+                    texTable[index] = texPaths[texData] + 1
+
+                newTexNums = array.array('H', map(texTable.__getitem__, oldTexNums))
+                if sys.byteorder == 'big':
+                    newTexNums.byteswap()
+                newVTEX = Subrecord({'tag':'VTEX', 'data':bytearray(newTexNums.tobytes())})
+                landRecord.setSubrecord(newVTEX)
 
     # Do this here so Tribunal/Bloodmoon dependencies come immediately after Morrowind.esm
     masters.update(newMasters)
 
-    numChanged = len(newRecords['LAND'])
+    numChanged = len(changedCoords)
     if numChanged <= 0:
+        # Otherwise a plugin from an earlier repack would keep edits that have since been undone
+        if removeUnchanged and os.path.isfile(pluginPath):
+            os.remove(pluginPath)
+            return 'The heightmap was not altered. Removed the previous plugin at "{}".'.format(pluginPath)
         return 'The heightmap was not altered. No plugin will be generated.'
-    else: 
-        recordCount = 0
-        for recordTag, recordDict in newRecords.items():
-            recordCount += len(recordDict)
-
-        flags = 0
-        if os.path.splitext(pluginPath)[1].lower() == '.esm':
-            flags = 1
-        
-        headerRecord = Record({
-            'tag':'TES3',
-            'flags':0,
-            # Consider adding command-line option for setting version/author/description
-            'subrecords':[{'tag':'HEDR', 'data':pack('<fI32s256sI', version, flags, '', '', recordCount)}]
-        })
-
-        for master in masters:
-            size = masters[master]
-            headerRecord.addSubrecord({'tag':'MAST', 'data':pack('<#sx', master)})
-            headerRecord.addSubrecord({'tag':'DATA', 'data':pack('<Q', size)})
-
-        newRecords['TES3']['0'] = headerRecord
 
-        writePlugin(pluginPath, newRecords)
+    flags = 0
+    if os.path.splitext(pluginPath)[1].lower() == '.esm':
+        flags = 1
+    
+    # The record count is filled in by PluginWriter
+    headerRecord = Record({
+        'tag':'TES3',
+        'flags':0,
+        # Consider adding command-line option for setting version/author/description
+        'subrecords':[{'tag':'HEDR', 'data':pack('<fI32s256sI', version, flags, '', '', 0)}]
+    })
+
+    for master in masters:
+        size = masters[master]
+        headerRecord.addSubrecord({'tag':'MAST', 'data':pack('<#sx', master)})
+        headerRecord.addSubrecord({'tag':'DATA', 'data':pack('<Q', size)})
+
+    with stats.phase('write'), PluginWriter(pluginPath, headerRecord) as plugin:
+        for texRecord in texRecords:
+            plugin.write(texRecord)
+
+        for coords in changedCoords:
+            imageWNAM = Subrecord({'tag':'WNAM', 'data':changedWNAMs[coords]})
+            # Pre-existing landscapes from plugins
+            if coords in oldLandRecords:
+                plugin.write(oldLandRecords[coords])
+                continue
 
-        return 'Generated WNAMS for {:d} cells.\nCreated new plugin at "{}"'.format(numChanged, pluginPath)
+            # New landscapes not from plugins
+            coordSubrecord = Subrecord({'tag':'INTV', 'data':pack('<2i', *coords)})
+            plugin.write(Record({
+                'tag':'LAND',
+                'flags':0,
+                'subrecords':[
+                    coordSubrecord,
+                    default.getSubrecord('DATA'),
+                    default.getSubrecord('VNML'),
+                    default.getSubrecord('VHGT'),
+                    imageWNAM
+                ]
+            }))
+
+        # Morrowind.exe won't display WNAMs for grid squares without CELL records
+        # OpenMW won't expand the map for grid squares without CELL records
+        # However, including these prevents automatic fish spawning
+        # Exterior CELLs can exist without LANDs, in which case they're left alone
+        if not noCells:
+            existingCells = set()
+            for index in indexes.values():
+                existingCells.update(index['cells'])
+            for coords in changedCoords:
+                if coords in oldLandRecords or coords in existingCells:
+                    continue
+                cellName = Subrecord({'tag':'NAME', 'data':bytearray(1)})
+                cellData = Subrecord({'tag':'DATA', 'data':pack('<I2i', 2, *coords)})
+                plugin.write(Record({
+                    'tag':'CELL',
+                    'flags':0,
+                    'subrecords':[
+                        cellName,
+                        cellData
+                    ]
+                }))
+
+    stats.count('texturesWritten', len(texRecords))
+    stats.count('recordsWritten', plugin.recordCount)
+    stats.count('bytesWritten', os.path.getsize(pluginPath))
+    return 'Generated WNAMS for {:d} cells.\nCreated new plugin at "{}"'.format(numChanged, pluginPath)
+
+
+######## Library API ########
+
+
+# Resolves a load order given as a plugin path, an openmw.cfg or morrowind.ini path, a list of plugin paths,
+# or a dict of plugin names to paths
+# esmOnly only applies to openmw.cfg and morrowind.ini, where plugins are listed alongside masters
+# Returns a dict of lowercase plugin names to paths in load order, or False if no plugins were found
+def loadOrderPlugins(loadOrder, esmOnly=False):
+    if isinstance(loadOrder, dict):
+        return {pluginName.lower():pluginPath for pluginName, pluginPath in loadOrder.items()} or False
+    if isinstance(loadOrder, (list, tuple)):
+        return {os.path.basename(pluginPath).lower():pluginPath for pluginPath in loadOrder} or False
+
+    path, directory, filename, extension = verifyPath(os.fspath(loadOrder), True)
+    if extension in ['.esp', '.esm', '.omwaddon']:
+        return {filename.lower():path}
+    elif extension == '.cfg':
+        return openMWPlugins(path, esmOnly)
+    elif extension == '.ini':
+        return MWPlugins(path, esmOnly)
+    return False
+
+# Extracts the WNAMs of a load order to a BMP in bmpDir, returning a message describing the result
+# Nothing is printed unless stats are given
+# If region is set as (left, bottom, right, top), only the cells inside of it are extracted
+# If tileSize is set, the map is written as tiles of that many cells per side
+# imageFormat may be '.bmp', '.png' or '.npy'
+def extract(loadOrder, bmpDir='', colored=False, esmOnly=False, lazy=False, cacheDir=False, jobs=1, stats=quietStats, region=None,
+        tileSize=None, imageFormat='.bmp'):
+    pluginDict = loadOrderPlugins(loadOrder, esmOnly)
+    if not pluginDict:
+        return 'Couldn\'t find any plugins in the provided load order.'
+    if not imageFormat in imageWriters:
+        return 'Images can only be extracted as {}.'.format(', '.join(imageWriters))
+    if bmpDir and not os.path.isdir(bmpDir):
+        return 'Couldn\'t find the output directory "{}".'.format(bmpDir)
+    return pluginsToBMP(pluginDict, bmpDir, colored, lazy, cacheDir, jobs, stats, region, tileSize, imageFormat)
+
+# Extracts the full heightmaps of a load order to a PFM image in pfmDir, returning a message describing the result
+# If region is set as (left, bottom, right, top), only the cells inside of it are extracted
+def extractHeights(loadOrder, pfmDir='', esmOnly=False, lazy=False, cacheDir=False, jobs=1, stats=quietStats, region=None):
+    pluginDict = loadOrderPlugins(loadOrder, esmOnly)
+    if not pluginDict:
+        return 'Couldn\'t find any plugins in the provided load order.'
+    if pfmDir and not os.path.isdir(pfmDir):
+        return 'Couldn\'t find the output directory "{}".'.format(pfmDir)
+    return pluginsToPFM(pluginDict, pfmDir, lazy, cacheDir, jobs, stats, region)
+
+# Resolves the load order a plugin is repacked against, which never includes the plugin itself
+def repackPlugins(loadOrder, pluginPath, esmOnly=False):
+    pluginDict = loadOrderPlugins(loadOrder, esmOnly)
+    if not pluginDict:
+        return False
+    outputPath = os.path.normcase(os.path.abspath(pluginPath))
+    return {pluginName:path for pluginName, path in pluginDict.items()
+        if os.path.normcase(os.path.abspath(path)) != outputPath} or False
+
+# Repacks an edited BMP or a directory of tiles against a load order into pluginPath, returning a message describing the result
+# Passing the same dict as memo to repeated calls keeps plugin indexes in memory, so only changed plugins are read again
+# If region is set as (left, bottom, right, top), cells of the image outside of it are ignored
+# Images may be BMPs, PNGs, .npy arrays or grayscale PGMs, with scale pixels per cell side
+# If removeUnchanged is set and the image matches the load order, a previous plugin at pluginPath is removed
+def repack(loadOrder, bmpPath, pluginPath='WNAM_Falsified.esp', noCells=False, keepSpec=False, esmOnly=False, lazy=False,
+        cacheDir=False, jobs=1, stats=quietStats, memo=None, region=None, scale=9, removeUnchanged=False):
+    pluginDict = repackPlugins(loadOrder, pluginPath, esmOnly)
+    if not pluginDict:
+        return 'Couldn\'t find any plugins in the provided load order.'
+    return BMPToPlugin(pluginDict, bmpPath, pluginPath, noCells, keepSpec, lazy, jobs, cacheDir, stats, memo, region, scale,
+        removeUnchanged)
+
+# Regenerates the WNAMs of a load order from its terrain into pluginPath, returning a message describing the result
+# Only cells whose WNAMs don't match their terrain are included
+# If region is set as (left, bottom, right, top), only the cells inside of it are regenerated
+def regenerate(loadOrder, pluginPath='WNAM_Falsified.esp', noCells=False, keepSpec=False, esmOnly=False, lazy=False, cacheDir=False,
+        jobs=1, stats=quietStats, memo=None, region=None):
+    pluginDict = repackPlugins(loadOrder, pluginPath, esmOnly)
+    if not pluginDict:
+        return 'Couldn\'t find any plugins in the provided load order.'
+    return regenerateToPlugin(pluginDict, pluginPath, noCells, keepSpec, lazy, jobs, cacheDir, stats, memo, region)
+
+# Size and modification time of each file, or None for files that don't exist
+def fileStates(paths):
+    states = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            states.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            states.append((path, None, None))
+    return tuple(states)
+
+# Repacks whenever the image, the load order or any plugin in it changes, until interrupted
+# Files are polled every interval seconds, and a change is only acted on once they've stopped changing between polls,
+# so images are not read while an editor is still saving them
+# Plugin indexes stay in memory between repacks, so only plugins that changed are read again
+# If every edit is undone, the plugin from the last repack is removed
+def watch(loadOrder, bmpPath, pluginPath='WNAM_Falsified.esp', noCells=False, keepSpec=False, esmOnly=False, lazy=False,
+        cacheDir=False, jobs=1, interval=0.5, stats=quietStats, region=None, scale=9):
+    memo = {}
+    loadOrderPaths = []
+    if isinstance(loadOrder, (str, os.PathLike)):
+        loadOrderPaths.append(loadOrder)
+    lastStates = None
+    repackedStates = None
+
+    stats.progress('Watching "{}" for changes. Press Ctrl+C to stop.'.format(bmpPath))
+    while True:
+        pluginDict = repackPlugins(loadOrder, pluginPath, esmOnly) or {}
+        # Tiles can be added to or removed from a directory too
+        imagePaths = [bmpPath]
+        if os.path.isdir(bmpPath):
+            imagePaths = [imagePath for imagePath, coords in imagesFromPath(bmpPath)]
+        states = fileStates(imagePaths + loadOrderPaths + list(pluginDict.values()))
+        # Nothing can be repacked until the image exists
+        if states == lastStates and states != repackedStates and imagePaths and states[0][1] is not None:
+            stats.progress(repack(pluginDict, bmpPath, pluginPath, noCells, keepSpec, False, lazy, cacheDir, jobs, stats, memo, region,
+                scale, True))
+            # Plugins removed from the load order don't need to stay in memory
+            for path in list(memo):
+                if not path in pluginDict.values():
+                    del memo[path]
+            repackedStates = states
+        lastStates = states
+        time.sleep(interval)
 
 
 ######## User input ########
@@ -826,16 +2269,32 @@ def MWPlugins(iniPath, esmOnly=False):
 def main(argv):
     print('')
     
-    response =    'Usage: WNAMtool.py extract -i <input plugin, openmw.cfg, or morrowind.ini path> -b [bmp output dir] [optional arguments]'
-    response += '\n                   repack  -i <input plugin, openmw.cfg, or morrowind.ini path> -b <bmp image path> -o [output plugin path] [optional arguments]'
+    response =    'Usage: WNAMtool.py extract -i <input plugin, openmw.cfg, or morrowind.ini path> -b [image output dir] [optional arguments]'
+    response += '\n                   repack  -i <input plugin, openmw.cfg, or morrowind.ini path> -b <bmp/png/npy/pgm image or tile dir path> -o [output plugin path] [optional arguments]'
+    response += '\n                   heights -i <input plugin, openmw.cfg, or morrowind.ini path> -b [pfm output dir] [optional arguments]'
+    response += '\n                   regenerate -i <input plugin, openmw.cfg, or morrowind.ini path> -o [output plugin path] [optional arguments]'
+    response += '\n                   watch   -i <input plugin, openmw.cfg, or morrowind.ini path> -b <bmp/png/npy/pgm image or tile dir path> -o [output plugin path] [optional arguments]'
     response += '\nOptional arguments:'
     response += '\n       [--color]:    Applies to extracting; if set, the image will use Morrowind\'s map colors. Don\'t use this if the image will be used for repacking.'
     response += '\n       [--nocells]:  Applies to repacking; if not set, CELL records will be created for corresponding LANDs if they don\'t already exist.'
     response += '\n       [--esm]:      Applies to extracting and repacking; will only read from/output master files. Used for compatibility with unmodified Morrowind.exe.'
     response += '\n       [--keepspec]: Applies to repacking; by default, VNML/VHGT are left out when possible, violating the plugin format. Set this to keep them in.'
+    response += '\n       [--cache <dir>]: Applies to extracting and repacking; plugin LAND/LTEX indexes are stored in this directory and reused while plugins are unchanged.'
+    response += '\n       [--jobs <n>]:  Applies to extracting and repacking; plugins are read in this many processes at once.'
+    response += '\n       [--mmap]:     Applies to extracting and repacking; plugins are memory-mapped and subrecords are only copied when used. Reduces time and memory for large load orders.'
+    response += '\n       [--profile]:  Applies to extracting and repacking; prints time spent in each phase, record/byte counts and peak memory afterwards.'
+    response += '\n       [--stats-json <path>]: Applies to extracting and repacking; writes the same statistics to a JSON file.'
+    response += '\n       [--format <bmp|png|npy>]: Applies to extracting; png is a compressed paletted image, and npy a raw int8 array of heights. Defaults to bmp. All of them can be repacked.'
+    response += '\n       [--tile <n>]:   Applies to extracting; the map is split into image tiles of n by n cells, leaving out tiles that are all seafloor. Repack them by passing their directory to -b.'
+    response += '\n       [--region <x0,y0,x1,y1>]: Applies to extracting and repacking; only cells between these two corners are read, extracted or repacked.'
+    response += '\n       [--scale <n>]: Applies to repacking; images have n by n pixels per cell, which are averaged down to 9 by 9. Must be at least 9, which is the default.'
+    response += '\n       [--interval <s>]: Applies to watching; how often the image and plugins are checked for changes. Defaults to 0.5 seconds.'
+    response += '\n       Heights writes the height of every vertex to a PFM image, and takes the same arguments as extracting except --color and --tile.'
+    response += '\n       Regenerating computes every WNAM from its LAND\'s VHGT and outputs the ones that differ, and takes the same arguments as repacking.'
+    response += '\n       Watching repacks again whenever the image or load order changes, and takes the same arguments as repacking.'
     response += '\n       Arguments with parameters in brackets [] are also optional.'
 
-    opts, args = getopt.gnu_getopt(argv, 'i:b:o:', longopts=['color', 'nocells', 'esm', 'keepspec'])
+    opts, args = getopt.gnu_getopt(argv, 'i:b:o:', longopts=['color', 'nocells', 'esm', 'keepspec', 'mmap', 'cache=', 'jobs=', 'profile', 'stats-json=', 'interval=', 'region=', 'tile=', 'scale=', 'format='])
     d = {
         'mode':False,
         '-i':False,
@@ -846,39 +2305,108 @@ def main(argv):
         d[opt] = arg
 
     for arg in args:
-        if arg in ['extract', 'repack']:
+        if arg in ['extract', 'repack', 'heights', 'regenerate', 'watch']:
             d['mode'] = arg
 
+    jobs = 1
+    if '--jobs' in d:
+        try:
+            jobs = max(int(d['--jobs']), 1)
+        except ValueError:
+            pass
+
+    region = None
+    if '--region' in d:
+        try:
+            x0, y0, x1, y1 = [int(n) for n in d['--region'].split(',')]
+            region = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+        except ValueError:
+            print(response)
+            return
+
+    tileSize = None
+    if '--tile' in d:
+        try:
+            tileSize = max(int(d['--tile']), 1)
+        except ValueError:
+            pass
+
+    imageFormat = '.bmp'
+    if '--format' in d:
+        imageFormat = '.' + d['--format'].lower().lstrip('.')
+        if not imageFormat in imageWriters:
+            print(response)
+            return
+
+    # Boxes have to be at least a pixel wide
+    scale = 9
+    if '--scale' in d:
+        try:
+            scale = int(d['--scale'])
+        except ValueError:
+            print(response)
+            return
+        if scale < 9:
+            print(response)
+            return
+
+    interval = 0.5
+    if '--interval' in d:
+        try:
+            interval = max(float(d['--interval']), 0.01)
+        except ValueError:
+            pass
+
+    # Statistics are only collected if they'll be shown
+    stats = Stats('--profile' in d or '--stats-json' in d)
+
     i = verifyPath(d['-i'], True)
     b = verifyPath(d['-b'], d['mode'] == 'repack')
     o = verifyPath(d['-o'], False)
 
     contentFiles = None
-    if i[3] in ['.esp', '.esm', '.omwaddon']:
-        contentFiles = {i[2].lower():i[0]}
-    elif i[3] == '.cfg':
-        contentFiles = openMWPlugins(i[0], '--esm' in d)
-    elif i[3] == '.ini':
-        contentFiles = MWPlugins(i[0], '--esm' in d)
+    if i[0]:
+        contentFiles = loadOrderPlugins(i[0], '--esm' in d)
     
     if d['mode'] == 'extract' and contentFiles:
-        response = pluginsToBMP(contentFiles, b[1], '--color' in d)
+        response = extract(contentFiles, b[1], '--color' in d, '--esm' in d, '--mmap' in d, d.get('--cache', False), jobs, stats, region, tileSize,
+            imageFormat)
+
+    elif d['mode'] == 'heights' and contentFiles:
+        response = extractHeights(contentFiles, b[1], '--esm' in d, '--mmap' in d, d.get('--cache', False), jobs, stats, region)
         
-    elif d['mode'] == 'repack' and contentFiles:
-        for name, path in contentFiles.items():
-            if path == o[0]:
-                del contentFiles[name]
-                break
-        if len(contentFiles) > 0 and b[3] == '.bmp':
-            outputPath = 'WNAM_Falsified.esp'
-            if '--esm' in d:
-                outputPath = 'WNAM_Falsified.esm'
-            if o[3] in ['.esp', '.esm', '.omwaddon']:
-                outputPath = o[0]
-            elif o[0]:
-                outputPath = os.path.join(o[1], outputPath)
-            response = BMPToPlugin(contentFiles, b[0], outputPath, '--nocells' in d, '--keepspec' in d)
+    elif (d['mode'] in ['repack', 'watch'] and contentFiles and (b[3].lower() in imageReaders or (b[0] and os.path.isdir(b[0])))
+            or d['mode'] == 'regenerate' and contentFiles):
+        outputPath = 'WNAM_Falsified.esp'
+        if '--esm' in d:
+            outputPath = 'WNAM_Falsified.esm'
+        if o[3] in ['.esp', '.esm', '.omwaddon']:
+            outputPath = o[0]
+        elif o[0]:
+            outputPath = os.path.join(o[1], outputPath)
+
+        if d['mode'] == 'regenerate':
+            response = regenerate(contentFiles, outputPath, '--nocells' in d, '--keepspec' in d, '--esm' in d, '--mmap' in d,
+                d.get('--cache', False), jobs, stats, None, region)
+        elif d['mode'] == 'repack':
+            response = repack(contentFiles, b[0], outputPath, '--nocells' in d, '--keepspec' in d, '--esm' in d, '--mmap' in d,
+                d.get('--cache', False), jobs, stats, None, region, scale)
+        else:
+            # The load order is read again on every check, so changes to it are picked up too
+            try:
+                watch(i[0], b[0], outputPath, '--nocells' in d, '--keepspec' in d, '--esm' in d, '--mmap' in d,
+                    d.get('--cache', False), jobs, interval, stats, region, scale)
+            except KeyboardInterrupt:
+                response = 'Stopped watching.'
             
     print(response)
 
-main(sys.argv[1:])
+    if '--profile' in d:
+        print('')
+        print(stats.summary())
+    if '--stats-json' in d:
+        with open(d['--stats-json'], mode='w') as f:
+            json.dump(stats.report(), f, indent=4)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
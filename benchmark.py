@@ -0,0 +1,387 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import getopt
+import platform
+import tempfile
+import tracemalloc
+import multiprocessing
+import concurrent.futures
+
+import WNAMtool
+
+
+######## Synthetic data ########
+
+
+# Writes a load order of depth plugins into dataDir, returning it like openMWPlugins does
+# The first plugin is a master with the given number of LANDs laid out in a square
+# Each later plugin overrides a share of those cells, and every plugin has its own LTEX records
+def synthesizeLoadOrder(dataDir, cells, textures=16, depth=1, seed=0):
+    rng = random.Random(seed)
+    side = max(math.ceil(cells ** 0.5), 1)
+
+    # Terrain subrecords are only ever copied around, so they can share the same random data
+    noise = rng.randbytes(65 * 65 * 3)
+    texBlocks = [WNAMtool.pack('<256H', *rng.choices(range(textures + 1), k=256)) for i in range(64)]
+
+    pluginDict = {}
+    for layer in range(depth):
+        if layer == 0:
+            name = 'Synthetic.esm'
+        else:
+            name = 'Synthetic{:d}.esp'.format(layer)
+        pluginPath = os.path.join(dataDir, name)
+        header = WNAMtool.Record({
+            'tag':'TES3',
+            'flags':0,
+            'subrecords':[{'tag':'HEDR', 'data':WNAMtool.pack('<fI32s256sI', 1.3, 0, 'benchmark', '', 0)}]
+        })
+
+        with WNAMtool.PluginWriter(pluginPath, header) as plugin:
+            for index in range(textures):
+                plugin.write(WNAMtool.Record({
+                    'tag':'LTEX',
+                    'flags':0,
+                    'subrecords':[
+                        {'tag':'NAME', 'data':WNAMtool.pack('<#sx', 'Synthetic{:d}_{:d}'.format(layer, index))},
+                        {'tag':'INTV', 'data':WNAMtool.pack('<I', index)},
+                        {'tag':'DATA', 'data':WNAMtool.pack('<#sx', 'tx_synthetic_{:d}_{:d}.dds'.format(layer, index))}
+                    ]
+                }))
+
+            for num in range(cells):
+                # Layer n overrides every (n+1)th cell
+                if num % (layer + 1) > 0:
+                    continue
+                plugin.write(WNAMtool.Record({
+                    'tag':'LAND',
+                    'flags':0,
+                    'subrecords':[
+                        {'tag':'INTV', 'data':WNAMtool.pack('<2i', num % side, num // side)},
+                        {'tag':'DATA', 'data':WNAMtool.pack('<I', 9)},
+                        {'tag':'VNML', 'data':noise},
+                        {'tag':'VHGT', 'data':WNAMtool.pack('<f', rng.uniform(-256, 256)) + noise[:4228]},
+                        {'tag':'WNAM', 'data':rng.randbytes(81)},
+                        {'tag':'VCLR', 'data':noise},
+                        {'tag':'VTEX', 'data':texBlocks[num % len(texBlocks)]}
+                    ]
+                }))
+
+        pluginDict[name.lower()] = pluginPath
+    return pluginDict
+
+# Writes the image extract would produce for a load order into bmpDir, with a share of its cells edited
+def synthesizeBMP(pluginDict, bmpDir, edited=0.01, seed=0):
+    rng = random.Random(seed)
+    lands = WNAMtool.landsFromIndexes(WNAMtool.pluginIndexes(pluginDict))
+    WNAMs = {coords: WNAM for coords, (pluginName, offset, WNAM) in lands.items()}
+
+    for coords in rng.sample(sorted(WNAMs), int(len(WNAMs) * edited)):
+        WNAMs[coords] = bytes((value + 1) % 256 for value in WNAMs[coords])
+
+    left = min(x for x, y in WNAMs)
+    bottom = min(y for x, y in WNAMs)
+    cellWidth = max(x for x, y in WNAMs) - left + 1
+    cellHeight = max(y for x, y in WNAMs) - bottom + 1
+    bmpPath = os.path.join(bmpDir, '{:d},{:d}.bmp'.format(left, bottom))
+    bands = WNAMtool.mapBandsFromWNAMs(WNAMs, left, bottom, cellWidth, cellHeight)
+    WNAMtool.BMPFromBands(bmpPath, cellWidth * 9, cellHeight * 9, bands)
+    return bmpPath
+
+def countRecords(pluginDict):
+    count = 0
+    for pluginPath in pluginDict.values():
+        with open(pluginPath, mode='rb') as f:
+            header = WNAMtool.Record(f)
+        count += WNAMtool.unpack('<296xI', header.getSubrecord('HEDR').data)[0]
+    return count
+
+
+######## Palette remapping ########
+
+
+# Per-pixel lookup that reading BMPs used before translation tables, kept for comparison
+def remapLoop(pixelData, palette):
+    b = bytearray()
+    for pixel in pixelData:
+        red = palette.r(pixel)
+        if red >= 128:
+            red -= 128
+        else:
+            red += 128
+        b.append(red)
+    return b
+
+def remapTable(pixelData, palette):
+    return bytearray(pixelData.translate(palette.heightTable()))
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def benchmarkRemap(width, height):
+    pixelData = os.urandom(width * height)
+    lines = []
+    for paletteName, palette in [('mono', WNAMtool.heightPalette()), ('color', WNAMtool.heightPalette(True))]:
+        loopResult, loopTime = timed(remapLoop, pixelData, palette)
+        tableResult, tableTime = timed(remapTable, pixelData, palette)
+        if loopResult != tableResult:
+            return 'Palette remapping results differ for the {} palette.'.format(paletteName)
+        lines.append('{:<6} {:d}x{:d}: loop {:.3f}s, table {:.4f}s ({:.0f}x faster)'.format(
+            paletteName, width, height, loopTime, tableTime, loopTime / max(tableTime, 1e-9)))
+    return '\n'.join(lines)
+
+
+######## Record memory ########
+
+
+# Subrecord and Record as they were before __slots__ and keyed subrecords, kept for comparison
+# Only what's needed to read LANDs is kept
+class LegacySubrecord():
+
+    def decode(self):
+        if isinstance(self.data, memoryview):
+            self.data = bytearray(self.data)
+
+    def __init__(self, i):
+        self.tag, size = WNAMtool.unpack('<4sI', i.read(8))
+        data = i.read(size)
+        if isinstance(data, memoryview):
+            self.data = data
+        else:
+            self.data = bytearray(data)
+
+class LegacyRecord():
+
+    def getSubrecord(self, tag, index=0):
+        try:
+            subrecord = self.subrecordsSorted[tag][index]
+        except:
+            return None
+        subrecord.decode()
+        return subrecord
+
+    def addSubrecord(self, subrecord):
+        self.subrecords.append(subrecord)
+        if not subrecord.tag in self.subrecordsSorted:
+            self.subrecordsSorted[subrecord.tag] = []
+        self.subrecordsSorted[subrecord.tag].append(subrecord)
+
+    def setId(self):
+        if self.tag == 'TES3':
+            self.id = self.plugin['name'].lower()
+        elif self.tag == 'LAND':
+            x, y = WNAMtool.unpack('<2i', (self.getSubrecord('INTV').data))
+            self.id = '{:d},{:d}'.format(x, y)
+
+    def setName(self):
+        if hasattr(self, 'id'):
+            self.name = self.id
+        else:
+            self.name = '{} {:X}'.format(self.plugin['name'], self.plugin['offset'])
+
+    def __init__(self, i, tags=False):
+        self.passed = False
+        self.subrecords = []
+        self.subrecordsSorted = {}
+
+        start = i.tell()
+        info = i.read(0x10)
+        self.plugin = {'name':os.path.basename(i.name), 'offset':start}
+        self.tag, size, self.flags = WNAMtool.unpack('<4sI4xI', info)
+        if tags and not self.tag in tags:
+            i.seek(size, 1)
+            self.passed = True
+            return
+
+        offset = i.tell()
+        while offset < start + size + 0x10:
+            self.addSubrecord(LegacySubrecord(i))
+            offset = i.tell()
+
+        self.setId()
+        self.setName()
+
+# Reads the LANDs of a load order the way recordsFromPlugins did with the legacy classes
+def legacyLandRecords(pluginDict, lazy):
+    records = {}
+    for pluginPath in pluginDict.values():
+        if lazy:
+            f = WNAMtool.PluginView(pluginPath)
+        else:
+            f = open(pluginPath, mode='rb')
+        with f:
+            header = LegacyRecord(f)
+            recordCount, = WNAMtool.unpack('<296xI', header.getSubrecord('HEDR').data)
+            for num in range(recordCount):
+                record = LegacyRecord(f, ['LAND'])
+                if not record.passed:
+                    records[record.name] = record
+    return records
+
+def landRecords(pluginDict, lazy):
+    return WNAMtool.recordsFromPlugins(pluginDict, ['LAND'], lazy)['LAND']
+
+# Memory held by parsed LAND records, not counting memory-mapped subrecord data
+def benchmarkRecordMemory(cells):
+    lines = []
+    with tempfile.TemporaryDirectory() as tempDir:
+        pluginDict = synthesizeLoadOrder(tempDir, cells, 0)
+        for version, reader in [('legacy', legacyLandRecords), ('slots', landRecords)]:
+            for lazy in [True, False]:
+                tracemalloc.start()
+                start = time.perf_counter()
+                records = reader(pluginDict, lazy)
+                seconds = time.perf_counter() - start
+                size = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                count = len(records)
+                lines.append('{:<6} {:<4} {:d} LANDs: {:.1f} MB, {:.0f} bytes per record, {:.2f}s'.format(
+                    version, 'mmap' if lazy else 'copy', count, size / 1e6, size / max(count, 1), seconds))
+                del records
+    return '\n'.join(lines)
+
+
+######## Extract/repack ########
+
+
+# Runs in a fresh process so peak memory only reflects this operation
+# Bytes read are counted by WNAMtool itself, so memory-mapped plugins and worker processes are included
+def runOperation(operation, pluginDict, bmpPath, outputPath, options):
+    stats = WNAMtool.Stats(quiet=True)
+    start = time.perf_counter()
+    if operation == 'extract':
+        WNAMtool.pluginsToBMP(pluginDict, outputPath, lazy=options['lazy'], cacheDir=options['cacheDir'], jobs=options['jobs'],
+            stats=stats)
+    else:
+        WNAMtool.BMPToPlugin(pluginDict, bmpPath, outputPath, lazy=options['lazy'], jobs=options['jobs'], cacheDir=options['cacheDir'],
+            stats=stats)
+    seconds = time.perf_counter() - start
+    return {'seconds':seconds, 'bytesRead':stats.counters.get('bytesRead', 0), 'peakRSS':stats.peakMemory()}
+
+def measureOperation(operation, pluginDict, bmpPath, outputPath, options):
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(runOperation, operation, pluginDict, bmpPath, outputPath, options).result()
+
+def benchmarkPipeline(cellCounts, textures, depth, edited, options):
+    results = []
+    for cells in cellCounts:
+        with tempfile.TemporaryDirectory() as tempDir:
+            dataDir = os.path.join(tempDir, 'Data Files')
+            outputDir = os.path.join(tempDir, 'output')
+            os.makedirs(dataDir)
+            os.makedirs(outputDir)
+            pluginDict = synthesizeLoadOrder(dataDir, cells, textures, depth)
+            bmpPath = synthesizeBMP(pluginDict, tempDir, edited)
+            records = countRecords(pluginDict)
+
+            runs = ['']
+            if options['cacheDir']:
+                runs = ['cold', 'warm']
+
+            for operation in ['extract', 'repack']:
+                # Each operation gets its own cache, so the first run of each is really cold
+                runOptions = dict(options)
+                if options['cacheDir']:
+                    runOptions['cacheDir'] = os.path.join(tempDir, 'cache', operation)
+                for run in runs:
+                    outputPath = outputDir
+                    if operation == 'repack':
+                        outputPath = os.path.join(outputDir, 'WNAM_Falsified.esp')
+                    result = measureOperation(operation, pluginDict, bmpPath, outputPath, runOptions)
+
+                    written = 0
+                    for item in os.listdir(outputDir):
+                        written += os.path.getsize(os.path.join(outputDir, item))
+                        os.remove(os.path.join(outputDir, item))
+
+                    result.update({
+                        'operation':operation,
+                        'cache':run or None,
+                        'cells':cells,
+                        'textures':textures,
+                        'depth':depth,
+                        'edited':edited,
+                        'records':records,
+                        'recordsPerSecond':records / max(result['seconds'], 1e-9),
+                        'bytesWritten':written
+                    })
+                    results.append(result)
+    return results
+
+def formatResults(results):
+    def megabytes(value):
+        if value is None:
+            return '-'
+        return '{:.1f}'.format(value / 1e6)
+
+    lines = ['{:<8} {:<5} {:>8} {:>8} {:>9} {:>12} {:>10} {:>10} {:>9}'.format(
+        'op', 'cache', 'cells', 'records', 'seconds', 'records/s', 'read MB', 'written MB', 'peak MB')]
+    for result in results:
+        lines.append('{:<8} {:<5} {:>8d} {:>8d} {:>9.3f} {:>12.0f} {:>10} {:>10} {:>9}'.format(
+            result['operation'], result['cache'] or '-', result['cells'], result['records'], result['seconds'],
+            result['recordsPerSecond'], megabytes(result['bytesRead']), megabytes(result['bytesWritten']),
+            megabytes(result['peakRSS'])))
+    return '\n'.join(lines)
+
+
+######## User input ########
+
+
+def main(argv):
+    response =    'Usage: benchmark.py [pipeline] [--cells <n,n,...>] [--textures <n>] [--depth <n>] [--edited <fraction>] [--mmap] [--jobs <n>] [--cache] [--json <path>]'
+    response += '\n                    remap      [--size <width>x<height>]'
+    response += '\n                    memory     [--cells <n>]'
+    response += '\nAll data is synthesized in a temporary directory. Results can be written as JSON to compare between versions.'
+
+    try:
+        opts, args = getopt.gnu_getopt(argv, '', longopts=['cells=', 'textures=', 'depth=', 'edited=', 'mmap', 'jobs=', 'cache', 'json=', 'size='])
+    except getopt.GetoptError:
+        print(response)
+        return
+    d = dict(opts)
+    mode = 'pipeline'
+    for arg in args:
+        if arg in ['pipeline', 'remap', 'memory']:
+            mode = arg
+
+    try:
+        cellCounts = [int(n) for n in d.get('--cells', '1000,10000').split(',')]
+        textures = int(d.get('--textures', 16))
+        depth = max(int(d.get('--depth', 1)), 1)
+        edited = float(d.get('--edited', 0.01))
+        jobs = max(int(d.get('--jobs', 1)), 1)
+        width, height = [int(n) for n in d.get('--size', '4608x4608').lower().split('x')]
+    except ValueError:
+        print(response)
+        return
+
+    if mode == 'remap':
+        print(benchmarkRemap(width, height))
+        return
+    if mode == 'memory':
+        print(benchmarkRecordMemory(cellCounts[-1]))
+        return
+
+    options = {'lazy':'--mmap' in d, 'jobs':jobs, 'cacheDir':'--cache' in d}
+    results = benchmarkPipeline(cellCounts, textures, depth, edited, options)
+    print(formatResults(results))
+
+    if '--json' in d:
+        report = {
+            'python':platform.python_version(),
+            'platform':platform.platform(),
+            'options':{'lazy':options['lazy'], 'jobs':jobs, 'cache':options['cacheDir']},
+            'results':results
+        }
+        with open(d['--json'], mode='w') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])